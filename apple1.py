@@ -8,10 +8,12 @@ try:
     requests_available = True
 except ImportError:
     requests_available = False
-import sys, argparse, threading
-from collections import deque
-from time import time, sleep
-from random import random
+import sys, os, re, argparse, threading, json, platform, statistics, struct, signal, asyncio, io, queue, hashlib, zlib, itertools, multiprocessing.connection
+from array import array
+from collections import deque, namedtuple
+from time import time, sleep, monotonic, perf_counter
+from random import random, Random
+from urllib.parse import quote
 from os.path import exists
 
 # --- ROM Data ---
@@ -107,8 +109,90 @@ $c1ae  ad 14 d0  LDA $d014
 $c1b1  60        RTS
 """
 
+# --- ALU Tables ---
+# Built once at import and shared by both MPUs. Entries hold the result in the
+# low byte and the flags the operation sets (N, V, Z, C) in the high byte;
+# callers clear those flags in p before or-ing them in. The 256-entry tables
+# are tuples, which CPython indexes a little faster; the ADC and SBC tables
+# are 16-bit arrays, a quarter of the memory of tuples of 128K ints.
+
+def _nz(value):
+    return (value & 0x80) | (0 if value else 0x02)
+
+def _adc(a, data, carry, decimal):
+    if decimal:
+        nibble0 = (data & 0xf) + (a & 0xf) + carry
+        halfcarry = 1 if nibble0 > 9 else 0
+        nibble1 = ((data >> 4) & 0xf) + ((a >> 4) & 0xf) + halfcarry
+        # flags come from the ALU output, A is decimally adjusted
+        aluresult = ((nibble1 & 0xf) << 4) + (nibble0 & 0xf)
+        flags = _nz(aluresult) | (1 if nibble1 > 9 else 0)
+        if ~(a ^ data) & (a ^ aluresult) & 0x80:
+            flags |= 0x40
+        result = ((((nibble1 & 0xf) + (6 if nibble1 > 9 else 0)) & 0xf) << 4) + (((nibble0 & 0xf) + (6 if halfcarry else 0)) & 0xf)
+    else:
+        result = data + a + carry
+        flags = 0x40 if ~(a ^ data) & (a ^ result) & 0x80 else 0
+        if result > 0xff:
+            flags |= 1
+            result &= 0xff
+        flags |= _nz(result)
+    return result | (flags << 8)
+
+def _sbc(a, data, carry, decimal):
+    aluresult = a + (data ^ 0xff) + carry
+    flags = 1 if aluresult > 0xff else 0
+    aluresult &= 0xff
+    flags |= _nz(aluresult)
+    if (a ^ data) & (a ^ aluresult) & 0x80:
+        flags |= 0x40
+    if decimal:
+        nibble0 = (a & 0xf) + (~data & 0xf) + carry
+        nibble1 = ((a >> 4) & 0xf) + ((~data >> 4) & 0xf) + (0 if nibble0 <= 0xf else 1)
+        result = ((((aluresult + (0xa0 if nibble1 <= 0xf else 0)) >> 4) & 0xf) << 4) + ((aluresult + (10 if nibble0 <= 0xf else 0)) & 0xf)
+    else:
+        result = aluresult
+    return result | (flags << 8)
+
+# N and Z for a byte
+NZ_FLAGS = tuple(_nz(v) for v in range(256))
+
+# Translated blocks keep N and Z lazily in nz, usually the last result:
+# N is set when nz & 0x180, Z when nz & 0xff == 0. This maps the flags byte
+# of the tables below to an nz value.
+NZ_LAZY = tuple(((f & 0x80) << 1) | (0 if f & 0x02 else 1) for f in range(256))
+
+def lazy_nz(p):
+    return ((p & 0x80) << 1) | (~p & 0x02)
+
+def fold_nz(p, nz):
+    return (p & 0x7d) | (0x80 if nz & 0x180 else 0) | (0 if nz & 0xff else 0x02)
+
+# indexed by value, or value | carry << 8 for rotates
+ASL_TABLE = tuple(((v << 1) & 0xff) | ((_nz((v << 1) & 0xff) | (v >> 7)) << 8) for v in range(256))
+LSR_TABLE = tuple((v >> 1) | ((_nz(v >> 1) | (v & 1)) << 8) for v in range(256))
+ROL_TABLE = tuple(((i << 1) & 0xff | (i >> 8)) | ((_nz(((i << 1) & 0xff) | (i >> 8)) | ((i >> 7) & 1)) << 8) for i in range(512))
+ROR_TABLE = tuple(((i & 0xff) >> 1 | (i >> 8) << 7) | ((_nz((i & 0xff) >> 1 | (i >> 8) << 7) | (i & 1)) << 8) for i in range(512))
+
+# indexed by carry << 16 | a << 8 | operand
+ADC_BINARY = array('H', (_adc((i >> 8) & 0xff, i & 0xff, i >> 16, False) for i in range(0x20000)))
+ADC_DECIMAL = array('H', (_adc((i >> 8) & 0xff, i & 0xff, i >> 16, True) for i in range(0x20000)))
+# binary SBC is ADC of the inverted operand: each row of ADC_BINARY reversed
+SBC_BINARY = array('H')
+for _row in range(0, 0x20000, 256):
+    SBC_BINARY += ADC_BINARY[_row:_row + 256][::-1]
+del _row
+SBC_DECIMAL = array('H', (_sbc((i >> 8) & 0xff, i & 0xff, i >> 16, True) for i in range(0x20000)))
+
+ALU_TABLES = {name: globals()[name] for name in (
+    'NZ_FLAGS', 'NZ_LAZY', 'ASL_TABLE', 'LSR_TABLE', 'ROL_TABLE', 'ROR_TABLE',
+    'ADC_BINARY', 'ADC_DECIMAL', 'SBC_BINARY', 'SBC_DECIMAL')}
+
 # --- 6502 Microprocessor Unit (Derived from Py65 emulator) ---
 
+# run()'s stop reason when a breakpoint ('exec') or watchpoint ('read', 'write') triggers
+Break = namedtuple('Break', 'address access value')
+
 class MPU6502:
     # vectors
     RESET = 0xfffc
@@ -130,7 +214,13 @@ class MPU6502:
     ADDR_WIDTH = 16
     ADDR_FORMAT = "%04x"
 
-    def __init__(self, memory=None, pc=None):
+    # CMOS parts clear D on BRK and do not wrap JMP ($xxFF) within the page
+    CMOS = False
+
+    # execution engines (see step())
+    ENGINES = ('generated', 'reference', 'translated')
+
+    def __init__(self, memory=None, pc=None, engine='generated'):
         # config
         self.name = '6502'
         self.byteMask = ((1 << self.BYTE_WIDTH) - 1)
@@ -148,6 +238,42 @@ class MPU6502:
         self.memory = memory
         self.start_pc = pc # if None, reset vector is used
 
+        # page table used by the generated and translated engines: pages whose
+        # read_map/write_map entry is None are plain memory in ram, the others
+        # go to handler(addr) and handler(addr, value). Zero page and stack are
+        # always ram. A memory object can provide its own ram and maps.
+        self.ram = getattr(memory, 'ram', memory)
+        self.read_map = getattr(memory, 'read_map', [None] * 256)
+        self.write_map = getattr(memory, 'write_map', [None] * 256)
+
+        # translated blocks, by entry address
+        self.block_cache = {}
+        self.page_blocks = {} # page -> entry addresses of blocks with code in it
+        self.block_globals = {'ram': self.ram, 'rmap': self.read_map, 'wmap': self.write_map, 'cpu': self, **ALU_TABLES}
+
+        # engine
+        if engine not in self.ENGINES:
+            raise ValueError(f'Unknown engine: {engine}')
+        self.engine = engine
+        self.step = getattr(self, engine + '_step')
+        self.run_loop = getattr(self, engine + '_run')
+        self.profiler = None # see profile()
+        self.tracer = None # see trace()
+        self.breakpoints = set() # see add_breakpoint()
+        self.break_pc = None # breakpoint the last run() stopped at
+        self.watchpoints = [] # (start, end, access), see add_watchpoint()
+        self.watched_pages = {} # page -> the (read, write) handlers it had
+        self.stop_reason = None # set by stop() to make run() return
+        self.pending_interrupts = deque()
+        self.written = None # page -> 1 if written, see track_writes()
+
+        # status registers that only change through an external event (or the
+        # passing of time), so a loop polling one can be fast-forwarded;
+        # translated code has to be flushed when this changes
+        self.poll_addresses = set()
+        self.poll_cycles = 0 # cycles per iteration of the last poll loop
+        self.poll_wake = 0 # cycle count at which a polled status changes by itself (e.g. a display getting ready)
+
         # init
         self.reset()
 
@@ -162,7 +288,9 @@ class MPU6502:
         return self.reprformat() % (indent, self.name, self.pc, self.a,
                                     self.x, self.y, self.sp, flags)
 
-    def step(self):
+    # step() is bound to one of these by __init__, depending on the engine
+
+    def reference_step(self):
         instructCode = self.memory[self.pc]
         self.pc = (self.pc + 1) & self.addrMask
         self.excycles = 0
@@ -172,6 +300,399 @@ class MPU6502:
         self.processorCycles += self.cycletime[instructCode] + self.excycles
         return self
 
+    def generated_step(self):
+        # fast_instruct handlers do their own decoding, pc and cycle updates;
+        # they fetch from ram, so code in (or running into) mapped pages runs
+        # through instruct
+        pc = self.pc
+        if self.read_map[pc >> 8] is None and self.read_map[((pc + 2) & 0xFFFF) >> 8] is None:
+            self.fast_instruct[self.ram[pc]](self, (pc + 1) & 0xFFFF)
+        else:
+            self.reference_step()
+        return self
+
+    def translated_step(self):
+        # runs a whole translated block; falls back to one generated step
+        # where the code can't be translated
+        pc = self.pc
+        block = self.block_cache.get(pc)
+        if block is None:
+            block = self.translate(pc)
+        if block:
+            self.pc, self.a, self.x, self.y, self.sp, p, nz, cycles = block(
+                self.a, self.x, self.y, self.sp, self.p, lazy_nz(self.p))
+            self.p = fold_nz(p, nz)
+            self.processorCycles += cycles
+            if self.stop_reason == 'poll':
+                self.stop_reason = None # only run() fast-forwards
+        else:
+            self.generated_step()
+        return self
+
+    # Batched execution
+
+    def run(self, max_cycles):
+        """
+        Runs for at least max_cycles cycles, or until stop() is called.
+        Returns the stop reason, 'idle' when polling, or None at the budget.
+        """
+        end = self.processorCycles + max_cycles
+        while True:
+            try:
+                self.run_loop(end)
+            finally:
+                reason, self.stop_reason = self.stop_reason, None
+            if reason != 'poll':
+                break
+            # the loop went round once without the status changing, and
+            # nothing else can change it before poll_wake: skip ahead in
+            # whole iterations, to the end of the budget or to poll_wake
+            # and carry on from there (poll_wake may have gone by during the
+            # iteration, after its read)
+            wake = self.processorCycles - self.poll_cycles < self.poll_wake < end
+            left = (self.poll_wake if wake else end) - self.processorCycles
+            if left > 0:
+                self.processorCycles += -(-left // self.poll_cycles) * self.poll_cycles
+            if not wake:
+                reason = 'idle'
+                break
+        while self.pending_interrupts:
+            if self.pending_interrupts.popleft() == 'nmi':
+                self.nmi()
+            else:
+                self.irq()
+        return reason
+
+    def run_to(self, pc, max_cycles):
+        """
+        Like run(), but also returns 'pc' as soon as an instruction leaves the CPU at pc.
+        Raises ValueError with a tracer or profiler, whose loops can't stop there.
+        """
+        if self.tracer or self.profiler:
+            raise ValueError('run_to() can not be used with a tracer or a profiler')
+        # a breakpoint of its own, so the breakpoints, watchpoints and
+        # interrupts run() handles still work
+        pc &= 0xFFFF
+        added = pc not in self.breakpoints
+        if added:
+            self.add_breakpoint(pc)
+        if self.pc == pc:
+            self.break_pc = pc # runs at least the instruction at pc
+        try:
+            reason = self.run(max_cycles)
+        finally:
+            if added:
+                self.breakpoints.discard(pc)
+                self.select_run_loop()
+        if added and isinstance(reason, Break) and reason.access == 'exec' and reason.address == pc:
+            return 'pc'
+        return reason
+
+    def polling(self):
+        """
+        The status register address when pc is in a poll loop (see
+        InstructionCompiler.poll_loop), else None; for the stepping engines.
+        """
+        ram, lengths = self.ram, self.compiler.LENGTHS
+        for start in (self.pc, (self.pc - 3) & 0xFFFF):
+            names, addr = [], start
+            for _ in range(2):
+                name, mode = self.disassemble[ram[addr]]
+                length = lengths.get(mode, 1)
+                names.append((name, mode, [ram[(addr + i) & 0xFFFF] for i in range(1, length)]))
+                addr = (addr + length) & 0xFFFF
+            if self.compiler.poll_loop(self, names):
+                operands = names[0][2]
+                return operands[0] | (operands[1] << 8)
+        return None
+
+    def stop(self, reason='stop'):
+        # makes run() return at the next instruction (or block) boundary
+        self.stop_reason = reason
+
+    def request_interrupt(self, kind='irq'):
+        # irq()/nmi() can't be called while run() holds the registers, so
+        # run() returns and takes the interrupt itself
+        self.pending_interrupts.append(kind)
+        self.stop('interrupt')
+
+    # run() uses one of these loops, depending on the engine; they run until
+    # processorCycles reaches end or stop() is called
+
+    def reference_run(self, end):
+        step = self.reference_step
+        while self.processorCycles < end and self.stop_reason is None:
+            step()
+
+    def generated_run(self, end):
+        ram, read_map, handlers = self.ram, self.read_map, self.fast_instruct
+        while self.processorCycles < end and self.stop_reason is None:
+            pc = self.pc
+            if read_map[pc >> 8] is None and read_map[((pc + 2) & 0xFFFF) >> 8] is None:
+                handlers[ram[pc]](self, (pc + 1) & 0xFFFF)
+            else:
+                self.reference_step()
+
+    def translated_run(self, end):
+        # registers, the lazy N/Z and the cycle count live in locals between
+        # blocks; p is only made whole again when they go back to self.
+        # processorCycles is set at the start of each block, device_call()
+        # moves it on for devices accessed further in.
+        cache, translate, generated_step = self.block_cache, self.translate, self.generated_step
+        pc, a, x, y, sp, p = self.pc, self.a, self.x, self.y, self.sp, self.p
+        nz = lazy_nz(p)
+        cycles = self.processorCycles
+        try:
+            while cycles < end and self.stop_reason is None:
+                block = cache.get(pc)
+                if block is None:
+                    block = translate(pc)
+                if block:
+                    self.processorCycles = cycles
+                    pc, a, x, y, sp, p, nz, n = block(a, x, y, sp, p, nz)
+                    cycles += n
+                else:
+                    self.pc, self.a, self.x, self.y, self.sp, self.p = pc, a, x, y, sp, fold_nz(p, nz)
+                    self.processorCycles = cycles
+                    generated_step()
+                    pc, a, x, y, sp, p = self.pc, self.a, self.x, self.y, self.sp, self.p
+                    nz = lazy_nz(p)
+                    cycles = self.processorCycles
+        finally:
+            self.pc, self.a, self.x, self.y, self.sp, self.p = pc, a, x, y, sp, fold_nz(p, nz)
+            self.processorCycles = cycles
+
+    def profiled_run(self, end):
+        # the run loop while a profiler is attached: the generated engine, with
+        # the instruction that takes the cycle count past the profiler's
+        # next_sample handed to it afterwards
+        profiler, ram, read_map, handlers = self.profiler, self.ram, self.read_map, self.fast_instruct
+        while self.processorCycles < end and self.stop_reason is None:
+            pc = self.pc
+            opcode = ram[pc]
+            cycles = self.processorCycles
+            if read_map[pc >> 8] is None and read_map[((pc + 2) & 0xFFFF) >> 8] is None:
+                handlers[opcode](self, (pc + 1) & 0xFFFF)
+            else:
+                self.reference_step()
+            if self.processorCycles > profiler.next_sample:
+                profiler.sample(pc, opcode, cycles, self.processorCycles)
+
+    def traced_run(self, end):
+        # the run loop while a tracer is attached: the generated engine, with
+        # the state before each instruction packed into the tracer's buffer
+        tracer, ram, read_map, handlers = self.tracer, self.ram, self.read_map, self.fast_instruct
+        pack, buffer, size, limit = tracer.RECORD.pack_into, tracer.buffer, tracer.RECORD.size, len(tracer.buffer)
+        offset = tracer.offset
+        try:
+            while self.processorCycles < end and self.stop_reason is None:
+                pc = self.pc
+                opcode = ram[pc]
+                pack(buffer, offset, self.processorCycles, pc, opcode, ram[(pc + 1) & 0xFFFF], ram[(pc + 2) & 0xFFFF],
+                     self.a, self.x, self.y, self.sp, self.p)
+                offset += size
+                if offset == limit:
+                    offset = 0
+                    tracer.wrapped = True
+                if read_map[pc >> 8] is None and read_map[((pc + 2) & 0xFFFF) >> 8] is None:
+                    handlers[opcode](self, (pc + 1) & 0xFFFF)
+                else:
+                    self.reference_step()
+        finally:
+            tracer.offset = offset
+
+    def profile(self, profiler):
+        """
+        Samples the code run() runs with profiler (a Profiler) through
+        profiled_run, until profile(None). Replaces a tracer.
+        """
+        if self.profiler:
+            self.profiler.stop(self.processorCycles)
+        self.profiler, self.tracer = profiler, None
+        if profiler:
+            profiler.start(self.processorCycles)
+        self.select_run_loop()
+
+    def trace(self, tracer):
+        """
+        Records every instruction run() runs in tracer (a Tracer), until
+        trace(None), through traced_run. Replaces a profiler.
+        """
+        if self.profiler:
+            self.profile(None)
+        self.tracer = tracer
+        if tracer:
+            tracer.name = self.name
+        self.select_run_loop()
+
+    def debug_run(self, end):
+        # the run loop while breakpoints or watchpoints are set: the generated
+        # engine, or the reference engine when zero page or stack is watched,
+        # stopping before an instruction at a breakpoint. A run() that stopped
+        # there carries on by running that instruction.
+        breakpoints, ram = self.breakpoints, self.ram
+        step = self.reference_step if 0 in self.watched_pages or 1 in self.watched_pages else self.generated_step
+        resume, self.break_pc = self.break_pc, None
+        while self.processorCycles < end and self.stop_reason is None:
+            pc = self.pc
+            if pc in breakpoints and pc != resume:
+                self.break_pc = pc
+                self.stop(Break(pc, 'exec', ram[pc]))
+                break
+            resume = None
+            step()
+
+    def select_run_loop(self):
+        # run() uses the engine's loop unless a tracer, a profiler, or
+        # breakpoints and watchpoints need one of the loops above, in that
+        # order (only debug_run stops at breakpoints, so main() doesn't let
+        # --break and --watch go with --trace or --profile)
+        if self.tracer:
+            self.run_loop = self.traced_run
+        elif self.profiler:
+            self.run_loop = self.profiled_run
+        elif self.breakpoints or self.watchpoints:
+            self.run_loop = self.debug_run
+        else:
+            self.run_loop = getattr(self, self.engine + '_run')
+
+    # Breakpoints and watchpoints: run() returns a Break when one triggers
+
+    def add_breakpoint(self, pc):
+        """Stops run() before the instruction at pc, returning Break(pc, 'exec', opcode)."""
+        self.breakpoints.add(pc & 0xFFFF)
+        self.select_run_loop()
+
+    def add_watchpoint(self, start, end=None, access='rw'):
+        """
+        Stops run() after an instruction reads ('r' in access) or writes ('w')
+        an address from start to end, returning Break(address, 'read' or 'write', value).
+        """
+        self.watchpoints.append((start & 0xFFFF, (start if end is None else end) & 0xFFFF, access))
+        self.watch_pages()
+        self.select_run_loop()
+
+    def clear_breakpoints(self):
+        """Removes all breakpoints and watchpoints, and their page handlers."""
+        self.breakpoints.clear()
+        self.watchpoints.clear()
+        self.watch_pages()
+        self.select_run_loop()
+
+    def watch_pages(self):
+        # puts the saved handlers back, then wraps those of the watched pages
+        for page, (read, write) in self.watched_pages.items():
+            self.read_map[page], self.write_map[page] = read, write
+        self.watched_pages = {}
+        for start, end, access in self.watchpoints:
+            for page in range(start >> 8, (end >> 8) + 1):
+                if page not in self.watched_pages:
+                    self.invalidate_page(page) # takes the write_code trap off
+                    self.untrack_page(page)
+                    self.watched_pages[page] = read, write = self.read_map[page], self.write_map[page]
+                    self.read_map[page] = self.watch_read(read)
+                    self.write_map[page] = self.watch_write(write)
+
+    def watch_read(self, handler):
+        ram, watchpoints = self.ram, self.watchpoints
+        def read(addr):
+            value = ram[addr] if handler is None else handler(addr)
+            for start, end, access in watchpoints:
+                if start <= addr <= end and 'r' in access:
+                    self.stop(Break(addr, 'read', value))
+            return value
+        return read
+
+    def watch_write(self, handler):
+        ram, watchpoints = self.ram, self.watchpoints
+        def write(addr, value):
+            if handler is None:
+                ram[addr] = value
+            else:
+                handler(addr, value)
+            for start, end, access in watchpoints:
+                if start <= addr <= end and 'w' in access:
+                    self.stop(Break(addr, 'write', value))
+        return write
+
+    # Block translation cache
+
+    def translate(self, pc):
+        src, pages = self.compiler.block_source(self, pc)
+        if src is None:
+            block = False
+            pages = (pc >> 8,)
+        else:
+            namespace = {}
+            exec(self.compiler.code(src, pc), self.block_globals, namespace)
+            block = namespace['_block']
+        self.block_cache[pc] = block
+        for page in pages:
+            if page > 1 and self.read_map[page] is None:
+                self.page_blocks.setdefault(page, set()).add(pc)
+                # RAM pages holding code get a write trap; pages that already
+                # have a handler (ROM) are left alone
+                if self.write_map[page] is None:
+                    self.write_map[page] = self.write_code
+        return block
+
+    def write_code(self, addr, value):
+        # write_map entry of RAM pages holding translated code
+        self.ram[addr] = value
+        self.invalidate_page(addr >> 8)
+
+    def invalidate_page(self, page):
+        if self.write_map[page] == self.write_code:
+            self.write_map[page] = None
+        for pc in self.page_blocks.pop(page, ()):
+            self.block_cache.pop(pc, None)
+
+    def flush_blocks(self):
+        for page in list(self.page_blocks):
+            self.invalidate_page(page)
+        self.block_cache.clear()
+
+    # Written page tracking
+
+    def track_writes(self):
+        """
+        Starts over noting which pages get written, in written, with a trap on
+        each plain RAM page that comes off at the first write.
+        """
+        written = self.written = bytearray(b'\x01') * 256
+        write_map, trap = self.write_map, self.write_written
+        plain = (None, self.write_code, trap)
+        for page in range(2, 256):
+            if write_map[page] in plain:
+                write_map[page] = trap
+                written[page] = 0
+
+    def write_written(self, addr, value):
+        # write_map entry of pages not written since track_writes()
+        page = addr >> 8
+        self.written[page] = 1
+        self.write_map[page] = None
+        if page in self.page_blocks:
+            self.write_code(addr, value)
+        else:
+            self.ram[addr] = value
+
+    def untrack_page(self, page):
+        """Counts page as written, for writes that don't go through the page table, and takes its trap off."""
+        if self.written is not None:
+            self.written[page] = 1
+            if self.write_map[page] == self.write_written:
+                self.write_map[page] = None
+
+    def device_call(self, cycles, handler, *args):
+        # calls a read or write handler from a block, with processorCycles
+        # moved on by the cycles run since the start of the block
+        start = self.processorCycles
+        self.processorCycles = start + cycles
+        result = handler(*args)
+        self.processorCycles = start
+        return result
+
     def reset(self):
         self.pc = self.start_pc
         if self.pc is None:
@@ -307,11 +828,7 @@ class MPU6502:
         return z
 
     def FlagsNZ(self, value):
-        self.p &= ~(self.ZERO | self.NEGATIVE)
-        if value == 0:
-            self.p |= self.ZERO
-        else:
-            self.p |= value & self.NEGATIVE
+        self.p = (self.p & ~(self.ZERO | self.NEGATIVE)) | NZ_FLAGS[value]
 
     # operations
 
@@ -320,48 +837,26 @@ class MPU6502:
         self.FlagsNZ(self.a)
 
     def opASL(self, x):
-        if x is None:
-            tbyte = self.a
-        else:
-            addr = x()
-            tbyte = self.ByteAt(addr)
-
-        self.p &= ~(self.CARRY | self.NEGATIVE | self.ZERO)
-
-        if tbyte & self.NEGATIVE:
-            self.p |= self.CARRY
-        tbyte = (tbyte << 1) & self.byteMask
-
-        if tbyte:
-            self.p |= tbyte & self.NEGATIVE
-        else:
-            self.p |= self.ZERO
-
-        if x is None:
-            self.a = tbyte
-        else:
-            self.memory[addr] = tbyte
+        self.opShift(x, ASL_TABLE, 0)
 
     def opLSR(self, x):
+        self.opShift(x, LSR_TABLE, 0)
+
+    def opShift(self, x, table, carry):
+        # shared by the shifts and rotates: table gives result and N, Z, C
         if x is None:
             tbyte = self.a
         else:
             addr = x()
             tbyte = self.ByteAt(addr)
 
-        self.p &= ~(self.CARRY | self.NEGATIVE | self.ZERO)
-        self.p |= tbyte & 1
-
-        tbyte = tbyte >> 1
-        if tbyte:
-            pass
-        else:
-            self.p |= self.ZERO
+        result = table[tbyte | carry]
+        self.p = (self.p & ~(self.CARRY | self.NEGATIVE | self.ZERO)) | (result >> 8)
 
         if x is None:
-            self.a = tbyte
+            self.a = result & 0xff
         else:
-            self.memory[addr] = tbyte
+            self.memory[addr] = result & 0xff
 
     def opBCL(self, x):
         if self.p & x:
@@ -393,29 +888,7 @@ class MPU6502:
         self.p |= tbyte & (self.NEGATIVE | self.OVERFLOW)
 
     def opROL(self, x):
-        if x is None:
-            tbyte = self.a
-        else:
-            addr = x()
-            tbyte = self.ByteAt(addr)
-
-        if self.p & self.CARRY:
-            if tbyte & self.NEGATIVE:
-                pass
-            else:
-                self.p &= ~self.CARRY
-            tbyte = (tbyte << 1) | 1
-        else:
-            if tbyte & self.NEGATIVE:
-                self.p |= self.CARRY
-            tbyte = tbyte << 1
-        tbyte &= self.byteMask
-        self.FlagsNZ(tbyte)
-
-        if x is None:
-            self.a = tbyte
-        else:
-            self.memory[addr] = tbyte
+        self.opShift(x, ROL_TABLE, (self.p & self.CARRY) << 8)
 
     def opEOR(self, x):
         self.a ^= self.ByteAt(x())
@@ -423,81 +896,13 @@ class MPU6502:
 
     def opADC(self, x):
         data = self.ByteAt(x())
-
-        if self.p & self.DECIMAL:
-            halfcarry = 0
-            decimalcarry = 0
-            adjust0 = 0
-            adjust1 = 0
-            nibble0 = (data & 0xf) + (self.a & 0xf) + (self.p & self.CARRY)
-            if nibble0 > 9:
-                adjust0 = 6
-                halfcarry = 1
-            nibble1 = ((data >> 4) & 0xf) + ((self.a >> 4) & 0xf) + halfcarry
-            if nibble1 > 9:
-                adjust1 = 6
-                decimalcarry = 1
-
-            # the ALU outputs are not decimally adjusted
-            nibble0 = nibble0 & 0xf
-            nibble1 = nibble1 & 0xf
-            aluresult = (nibble1 << 4) + nibble0
-
-            # the final A contents will be decimally adjusted
-            nibble0 = (nibble0 + adjust0) & 0xf
-            nibble1 = (nibble1 + adjust1) & 0xf
-            self.p &= ~(self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO)
-            if aluresult == 0:
-                self.p |= self.ZERO
-            else:
-                self.p |= aluresult & self.NEGATIVE
-            if decimalcarry == 1:
-                self.p |= self.CARRY
-            if (~(self.a ^ data) & (self.a ^ aluresult)) & self.NEGATIVE:
-                self.p |= self.OVERFLOW
-            self.a = (nibble1 << 4) + nibble0
-        else:
-            if self.p & self.CARRY:
-                tmp = 1
-            else:
-                tmp = 0
-            result = data + self.a + tmp
-            self.p &= ~(self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO)
-            if (~(self.a ^ data) & (self.a ^ result)) & self.NEGATIVE:
-                self.p |= self.OVERFLOW
-            data = result
-            if data > self.byteMask:
-                self.p |= self.CARRY
-                data &= self.byteMask
-            if data == 0:
-                self.p |= self.ZERO
-            else:
-                self.p |= data & self.NEGATIVE
-            self.a = data
+        table = ADC_DECIMAL if self.p & self.DECIMAL else ADC_BINARY
+        result = table[((self.p & self.CARRY) << 16) | (self.a << 8) | data]
+        self.p = (self.p & ~(self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO)) | (result >> 8)
+        self.a = result & 0xff
 
     def opROR(self, x):
-        if x is None:
-            tbyte = self.a
-        else:
-            addr = x()
-            tbyte = self.ByteAt(addr)
-
-        if self.p & self.CARRY:
-            if tbyte & 1:
-                pass
-            else:
-                self.p &= ~self.CARRY
-            tbyte = (tbyte >> 1) | self.NEGATIVE
-        else:
-            if tbyte & 1:
-                self.p |= self.CARRY
-            tbyte = tbyte >> 1
-        self.FlagsNZ(tbyte)
-
-        if x is None:
-            self.a = tbyte
-        else:
-            self.memory[addr] = tbyte
+        self.opShift(x, ROR_TABLE, (self.p & self.CARRY) << 8)
 
     def opSTA(self, x):
         self.memory[x()] = self.a
@@ -519,55 +924,10 @@ class MPU6502:
 
     def opSBC(self, x):
         data = self.ByteAt(x())
-
-        if self.p & self.DECIMAL:
-            halfcarry = 1
-            decimalcarry = 0
-            adjust0 = 0
-            adjust1 = 0
-
-            nibble0 = (self.a & 0xf) + (~data & 0xf) + (self.p & self.CARRY)
-            if nibble0 <= 0xf:
-                halfcarry = 0
-                adjust0 = 10
-            nibble1 = ((self.a >> 4) & 0xf) + ((~data >> 4) & 0xf) + halfcarry
-            if nibble1 <= 0xf:
-                adjust1 = 10 << 4
-
-            # the ALU outputs are not decimally adjusted
-            aluresult = self.a + (~data & self.byteMask) + \
-                (self.p & self.CARRY)
-
-            if aluresult > self.byteMask:
-                decimalcarry = 1
-            aluresult &= self.byteMask
-
-            # but the final result will be adjusted
-            nibble0 = (aluresult + adjust0) & 0xf
-            nibble1 = ((aluresult + adjust1) >> 4) & 0xf
-
-            self.p &= ~(self.CARRY | self.ZERO | self.NEGATIVE | self.OVERFLOW)
-            if aluresult == 0:
-                self.p |= self.ZERO
-            else:
-                self.p |= aluresult & self.NEGATIVE
-            if decimalcarry == 1:
-                self.p |= self.CARRY
-            if ((self.a ^ data) & (self.a ^ aluresult)) & self.NEGATIVE:
-                self.p |= self.OVERFLOW
-            self.a = (nibble1 << 4) + nibble0
-        else:
-            result = self.a + (~data & self.byteMask) + (self.p & self.CARRY)
-            self.p &= ~(self.CARRY | self.ZERO | self.OVERFLOW | self.NEGATIVE)
-            if ((self.a ^ data) & (self.a ^ result)) & self.NEGATIVE:
-                self.p |= self.OVERFLOW
-            data = result & self.byteMask
-            if data == 0:
-                self.p |= self.ZERO
-            if result > self.byteMask:
-                self.p |= self.CARRY
-            self.p |= data & self.NEGATIVE
-            self.a = data
+        table = SBC_DECIMAL if self.p & self.DECIMAL else SBC_BINARY
+        result = table[((self.p & self.CARRY) << 16) | (self.a << 8) | data]
+        self.p = (self.p & ~(self.CARRY | self.OVERFLOW | self.NEGATIVE | self.ZERO)) | (result >> 8)
+        self.a = result & 0xff
 
     def opDECR(self, x):
         if x is None:
@@ -1386,18 +1746,45 @@ class MPU6502:
         self.pc += 2
 
 class MPU65C02(MPU6502):
+    CMOS = True
+
     def __init__(self, *args, **kwargs):
         MPU6502.__init__(self, *args, **kwargs)
         self.name = '65C02'
         self.waiting = False
 
-    def step(self):
+    def reference_step(self):
         if self.waiting:
             self.processorCycles += 1
         else:
-            MPU6502.step(self)
+            MPU6502.reference_step(self)
         return self
 
+    def generated_step(self):
+        if self.waiting:
+            self.processorCycles += 1
+        else:
+            MPU6502.generated_step(self)
+        return self
+
+    def translated_step(self):
+        if self.waiting:
+            self.processorCycles += 1
+        else:
+            MPU6502.translated_step(self)
+        return self
+
+    def run(self, max_cycles):
+        # WAI stops the fast loops; the rest of the budget is spent waiting,
+        # one cycle per step as in step()
+        end = self.processorCycles + max_cycles
+        reason = None if self.waiting else MPU6502.run(self, max_cycles)
+        if self.waiting:
+            self.processorCycles = max(self.processorCycles, end)
+            if reason == 'wait':
+                reason = None
+        return reason
+
     # Make copies of the lists
     instruct = MPU6502.instruct[:]
     cycletime = MPU6502.cycletime[:]
@@ -1686,6 +2073,557 @@ class MPU65C02(MPU6502):
         self.x = self.stPop()
         self.FlagsNZ(self.x)
 
+# operand formats by addressing mode, for the byte and the word (or branch target)
+OPERAND_FORMATS = {'imp': '', 'acc': ' A', 'imm': ' #${0:02x}', 'zpg': ' ${0:02x}',
+                   'zpx': ' ${0:02x},X', 'zpy': ' ${0:02x},Y', 'inx': ' (${0:02x},X)',
+                   'iny': ' (${0:02x}),Y', 'zpi': ' (${0:02x})', 'rel': ' ${1:04x}',
+                   'abs': ' ${1:04x}', 'abx': ' ${1:04x},X', 'aby': ' ${1:04x},Y',
+                   'ind': ' (${1:04x})', 'iax': ' (${1:04x},X)'}
+
+def disassemble_instruction(disassemble, pc, code):
+    """
+    The instruction at pc as text in the style of the ROM listings, from an
+    MPU's disassemble table and the instruction's bytes (opcode first).
+    """
+    name, mode = disassemble[code[0]]
+    byte = code[1] if len(code) > 1 else 0
+    word = byte | (code[2] << 8 if len(code) > 2 else 0)
+    if mode == 'rel':
+        word = (pc + 2 + (byte ^ 0x80) - 0x80) & 0xFFFF
+    return name + OPERAND_FORMATS[mode].format(byte, word)
+
+# --- Instruction Compiler ---
+
+class InstructionCompiler:
+    """
+    Generates Python source for MPU instructions from the disassemble table,
+    working on the locals pc, a, x, y, sp, p (and nz in translated blocks).
+    """
+    LENGTHS = {'imp': 1, 'acc': 1, 'imm': 2, 'zpg': 2, 'zpx': 2, 'zpy': 2,
+               'inx': 2, 'iny': 2, 'zpi': 2, 'rel': 2, 'abs': 3, 'abx': 3,
+               'aby': 3, 'ind': 3, 'iax': 3}
+    REGISTERS = ('a', 'x', 'y', 'sp', 'p')
+
+    # (flag, branch when set) for each conditional branch
+    BRANCHES = {'BPL': (0x80, False), 'BMI': (0x80, True),
+                'BVC': (0x40, False), 'BVS': (0x40, True),
+                'BCC': (0x01, False), 'BCS': (0x01, True),
+                'BNE': (0x02, False), 'BEQ': (0x02, True)}
+    FLAG_OPS = {'CLC': 0x01, 'CLI': 0x04, 'CLD': 0x08, 'CLV': 0x40,
+                'SEC': 0x01, 'SEI': 0x04, 'SED': 0x08}
+    TRANSFERS = {'TAX': ('x', 'a'), 'TAY': ('y', 'a'), 'TXA': ('a', 'x'),
+                 'TYA': ('a', 'y'), 'TSX': ('x', 'sp')}
+    STEPS = {'INX': ('x', 1), 'INY': ('y', 1), 'DEX': ('x', -1), 'DEY': ('y', -1)}
+    LOADS = {'LDA': 'a', 'LDX': 'x', 'LDY': 'y', 'PLA': 'a', 'PLX': 'x', 'PLY': 'y'}
+    STORES = {'STA': 'a', 'STX': 'x', 'STY': 'y', 'STZ': '0'}
+    PUSHES = {'PHA': 'a', 'PHX': 'x', 'PHY': 'y', 'PHP': 'p | 0x30'}
+    LOGIC = {'ORA': '|', 'AND': '&', 'EOR': '^'}
+    COMPARES = {'CMP': 'a', 'CPX': 'x', 'CPY': 'y'}
+    SHIFTS = ('ASL', 'LSR', 'ROL', 'ROR', 'INC', 'DEC')
+    ZERO_PAGE = ('zpg', 'zpx', 'zpy')
+    MEMORY = {'ram': 'ram', 'rmap': 'read_map', 'wmap': 'write_map'} # local -> MPU attribute
+    ENDS_BLOCK = ('JMP', 'JSR', 'RTS', 'RTI', 'BRK', 'BRA', 'WAI') + tuple(BRANCHES)
+    POLL_READS = ('LDA', 'LDX', 'LDY', 'BIT')
+    PAGE_CROSSED = 'if (b ^ t) & 0xff00: cyc += 1' # b + index = t
+
+    # longest run of instructions translated into one block
+    BLOCK_LIMIT = 64
+    # compiled blocks kept for other machines running the same code
+    CODE_CACHE_SIZE = 4096
+
+    def __init__(self, mpu):
+        self.mpu = mpu
+        self.address = None # address of the instruction, when known
+        self.operands = ()
+        self.code_cache = {} # block source -> code object
+
+    # Operand and address helpers
+
+    def byte(self):
+        if self.address is None:
+            return 'ram[pc]'
+        return f'0x{self.operands[0]:02x}'
+
+    def word(self):
+        if self.address is None:
+            return 'ram[pc] + (ram[(pc + 1) & 0xffff] << 8)'
+        return f'0x{self.operands[0] | (self.operands[1] << 8):04x}'
+
+    @staticmethod
+    def page(addr):
+        if addr.startswith('0x'):
+            return f'0x{int(addr, 16) >> 8:02x}'
+        return f'({addr}) >> 8' if ' ' in addr else f'{addr} >> 8'
+
+    def load(self, addr):
+        """Expression for the byte at addr, through the page table."""
+        page = self.page(addr)
+        return f'(ram[{addr}] if rmap[{page}] is None else {self.device(f"rmap[{page}]", addr)})'
+
+    def device(self, handler, *args):
+        """
+        Call of a read or write handler; past a block's first instruction it
+        goes through cpu.device_call() with the cycle count at the instruction.
+        """
+        args = ', '.join(args)
+        if self.address is None or not self.elapsed:
+            return f'{handler}({args})'
+        return f'cpu.device_call(cyc + {self.elapsed}, {handler}, {args})'
+
+    def read(self, dest, addr, zp=False):
+        if zp:
+            return [f'{dest} = ram[{addr}]']
+        return [f'{dest} = {self.load(addr)[1:-1]}']
+
+    def write(self, addr, value, zp=False):
+        if zp:
+            return [f'ram[{addr}] = {value}']
+        lines = [f'm = wmap[{self.page(addr)}]',
+                 'if m is None:',
+                 f'    ram[{addr}] = {value}',
+                 'else:',
+                 f'    {self.device("m", addr, value)}']
+        if self.address is not None:
+            lines.append('    w = 1')
+        return lines
+
+    def push(self, value):
+        return self.write('sp + 256', value, True) + ['sp = (sp - 1) & 0xff']
+
+    def pop(self, dest):
+        return ['sp = (sp + 1) & 0xff'] + self.read(dest, 'sp + 256', True)
+
+    def flags_nz(self, value):
+        if self.lazy:
+            return [f'nz = {value}']
+        return [f'p = (p & 0x7d) | NZ_FLAGS[{value}]']
+
+    def flags_z(self, value):
+        # only Z changes; N is kept
+        if self.lazy:
+            return [f'nz = (0x100 if nz & 0x180 else 0) | (1 if {value} else 0)']
+        return [f'p = (p & 0xfd) | (0 if {value} else 2)']
+
+    def flag_test(self, flag):
+        """Expression that is true when flag is set."""
+        if self.lazy and flag == 0x80:
+            return 'nz & 0x180'
+        elif self.lazy and flag == 0x02:
+            return 'not nz & 0xff'
+        return f'p & 0x{flag:02x}'
+
+    def materialize_nz(self):
+        # folds the lazy N/Z into p
+        if self.lazy:
+            return ['p = (p & 0x7d) | (0x80 if nz & 0x180 else 0) | (0 if nz & 0xff else 2)']
+        return []
+
+    def lazy_nz(self):
+        # derives nz from p, after p was loaded
+        if self.lazy:
+            return ['nz = ((p & 0x80) << 1) | (~p & 2)']
+        return []
+
+    def effective_address(self, mode, extra):
+        """Returns lines that leave the effective address in t."""
+        if mode == 'zpg':
+            return [f't = {self.byte()}']
+        elif mode == 'zpx':
+            return [f't = ({self.byte()} + x) & 0xff']
+        elif mode == 'zpy':
+            return [f't = ({self.byte()} + y) & 0xff']
+        elif mode == 'abs':
+            return [f't = {self.word()}']
+        elif mode in ('abx', 'aby'):
+            index = 'x' if mode == 'abx' else 'y'
+            if not extra:
+                return [f't = ({self.word()} + {index}) & 0xffff']
+            return [f'b = {self.word()}',
+                    f't = (b + {index}) & 0xffff',
+                    self.PAGE_CROSSED]
+        elif mode == 'inx':
+            return [f'z = ({self.byte()} + x) & 0xff',
+                    't = ram[z] + (ram[(z + 1) & 0xff] << 8)']
+        elif mode == 'iny':
+            lines = [f'z = {self.byte()}',
+                     'b = ram[z] + (ram[(z + 1) & 0xff] << 8)',
+                     't = (b + y) & 0xffff']
+            if extra:
+                lines.append(self.PAGE_CROSSED)
+            return lines
+        elif mode == 'zpi':
+            return [f'z = {self.byte()}',
+                    't = ram[z] + (ram[z + 1] << 8)']
+        raise KeyError(mode)
+
+    def operand(self, mode, extra):
+        """Returns lines that leave the operand value in v."""
+        if mode == 'imm':
+            return [f'v = {self.byte()}']
+        return self.effective_address(mode, extra) + self.read('v', 't', mode in self.ZERO_PAGE)
+
+    # Instructions
+
+    def compile(self, opcode, address=None, operands=(), elapsed=0):
+        """
+        Returns (lines, next_pc expression) for an opcode, KeyError if it has no
+        template. elapsed is the cycles of the block's instructions before it.
+        """
+        mpu = self.mpu
+        name, mode = mpu.disassemble[opcode]
+        extra = mpu.extracycles[opcode]
+        length = self.LENGTHS[mode]
+        self.address, self.operands, self.elapsed = address, operands, elapsed
+        self.lazy = address is not None
+        if address is not None:
+            next_pc = f'0x{(address + length) & 0xffff:04x}'
+        elif length > 1:
+            next_pc = f'(pc + {length - 1}) & 0xffff'
+        else:
+            next_pc = 'pc'
+        lines = []
+
+        if name in self.LOADS:
+            reg = self.LOADS[name]
+            if mode == 'imp':
+                lines += self.pop(reg)
+            else:
+                lines += self.operand(mode, extra) + [f'{reg} = v']
+            lines += self.flags_nz(reg)
+        elif name in self.STORES:
+            lines += self.effective_address(mode, extra)
+            lines += self.write('t', self.STORES[name], mode in self.ZERO_PAGE)
+        elif name in self.LOGIC:
+            lines += self.operand(mode, extra)
+            lines += [f'a {self.LOGIC[name]}= v'] + self.flags_nz('a')
+        elif name in self.COMPARES:
+            lines += self.operand(mode, extra)
+            lines += [f'd = {self.COMPARES[name]} - v']
+            if self.lazy:
+                lines += ['p = (p & 0xfe) | (1 if d >= 0 else 0)', 'nz = d & 0xff']
+            else:
+                lines += ['p = (p & 0x7c) | (d & 0x80) | (1 if d >= 0 else 0) | (0 if d else 2)']
+        elif name == 'ADC':
+            lines += self.operand(mode, extra) + self.adc()
+        elif name == 'SBC':
+            lines += self.operand(mode, extra) + self.sbc()
+        elif name == 'BIT':
+            lines += self.operand(mode, extra)
+            if mode == 'imm':
+                # immediate BIT only affects Z
+                lines += self.flags_z('a & v')
+            elif self.lazy:
+                lines += ['p = (p & 0xbf) | (v & 0x40)', 'nz = (v & 0x80) << 1 | (1 if a & v else 0)']
+            else:
+                lines += ['p = (p & 0x3d) | (v & 0xc0) | (0 if a & v else 2)']
+        elif name in self.SHIFTS:
+            if mode == 'acc':
+                lines += ['v = a'] + self.shift(name) + ['a = r']
+            else:
+                zp = mode in self.ZERO_PAGE
+                lines += self.effective_address(mode, extra) + self.read('v', 't', zp)
+                lines += self.shift(name) + self.write('t', 'r', zp)
+        elif name in self.TRANSFERS:
+            dest, src = self.TRANSFERS[name]
+            lines += [f'{dest} = {src}'] + self.flags_nz(dest)
+        elif name == 'TXS':
+            lines += ['sp = x']
+        elif name in self.STEPS:
+            reg, delta = self.STEPS[name]
+            lines += [f'{reg} = ({reg} {"+" if delta > 0 else "-"} 1) & 0xff']
+            lines += self.flags_nz(reg)
+        elif name in self.FLAG_OPS:
+            flag = self.FLAG_OPS[name]
+            if name.startswith('CL'):
+                lines += [f'p &= 0x{0xff ^ flag:02x}']
+            else:
+                lines += [f'p |= 0x{flag:02x}']
+        elif name in self.PUSHES:
+            if name == 'PHP':
+                lines += self.materialize_nz()
+            lines += self.push(self.PUSHES[name])
+        elif name == 'PLP':
+            lines += self.pop('v') + ['p = v | 0x30'] + self.lazy_nz()
+        elif name in ('TSB', 'TRB'):
+            zp = mode in self.ZERO_PAGE
+            lines += self.effective_address(mode, extra) + self.read('v', 't', zp)
+            lines += self.flags_z('v & a')
+            lines += self.write('t', 'v | a' if name == 'TSB' else 'v & (a ^ 0xff)', zp)
+        elif name[:3] in ('RMB', 'SMB'):
+            bit = 1 << int(name[3])
+            lines += self.effective_address(mode, extra) + self.read('v', 't', True)
+            if name.startswith('RMB'):
+                lines += self.write('t', f'v & 0x{0xff ^ bit:02x}', True)
+            else:
+                lines += self.write('t', f'v | 0x{bit:02x}', True)
+        elif name == 'NOP':
+            pass
+        elif name == 'WAI':
+            lines += ['cpu.waiting = True', "cpu.stop_reason = 'wait'"]
+        elif name == '???':
+            # not implemented: skips one byte, takes no cycles
+            if address is None:
+                next_pc = '(pc + 1) & 0xffff'
+            else:
+                next_pc = f'0x{(address + 2) & 0xffff:04x}'
+        else:
+            lines, next_pc = self.control(name, mode)
+
+        if self.PAGE_CROSSED in lines:
+            # devices see the cycles before the instruction, so its page
+            # crossing cycle is counted after its memory accesses
+            lines.remove(self.PAGE_CROSSED)
+            lines.append(self.PAGE_CROSSED)
+        return lines, next_pc
+
+    def shift(self, name):
+        """Read-modify-write ALU ops: v in, r out."""
+        if name in ('ASL', 'LSR', 'ROL', 'ROR'):
+            index = 'v' if name in ('ASL', 'LSR') else 'v | (p & 1) << 8'
+            if self.lazy:
+                return [f'r = {name}_TABLE[{index}]', 'p = (p & 0xfe) | (r >> 8 & 1)', 'r &= 0xff', 'nz = r']
+            return [f'r = {name}_TABLE[{index}]', 'p = (p & 0x7c) | (r >> 8)', 'r &= 0xff']
+        elif name == 'INC':
+            return ['r = (v + 1) & 0xff'] + self.flags_nz('r')
+        else:
+            return ['r = (v - 1) & 0xff'] + self.flags_nz('r')
+
+    def adc(self):
+        return ['r = (ADC_DECIMAL if p & 0x08 else ADC_BINARY)[(p & 1) << 16 | a << 8 | v]'] + self.alu_flags()
+
+    def sbc(self):
+        return ['r = (SBC_DECIMAL if p & 0x08 else SBC_BINARY)[(p & 1) << 16 | a << 8 | v]'] + self.alu_flags()
+
+    def alu_flags(self):
+        # N and Z come from the table too: in decimal mode they don't follow the result
+        if self.lazy:
+            return ['p = (p & 0xbe) | (r >> 8 & 0x41)', 'nz = NZ_LAZY[r >> 8]', 'a = r & 0xff']
+        return ['p = (p & 0x3c) | (r >> 8)', 'a = r & 0xff']
+
+    def control(self, name, mode):
+        """Instructions that load pc; they leave the new pc in pc."""
+        if self.address is not None:
+            return self.static_control(name, mode)
+        lines = []
+        if name in self.BRANCHES or name == 'BRA':
+            if name == 'BRA':
+                lines += ['if True:']
+            else:
+                flag, when_set = self.BRANCHES[name]
+                lines += [f'if {"" if when_set else "not "}p & 0x{flag:02x}:']
+            lines += ['    cyc += 1',
+                      f'    o = {self.byte()}',
+                      '    pc += 1',
+                      '    t = pc - (o ^ 0xff) - 1 if o & 0x80 else pc + o',
+                      '    if (pc ^ t) & 0xff00: cyc += 1',
+                      '    pc = t & 0xffff',
+                      'else:',
+                      '    pc += 1']
+        elif name == 'JMP':
+            if mode == 'abs':
+                lines += [f'pc = {self.word()}']
+            elif mode == 'ind':
+                lines += [f't = {self.word()}']
+                if self.mpu.CMOS:
+                    lines += [f'pc = {self.load("t")} + ({self.load("(t + 1) & 0xffff")} << 8)']
+                else:
+                    lines += [f'pc = {self.load("t")} + ({self.load("(t & 0xff00) + ((t + 1) & 0xff)")} << 8)']
+            else:
+                lines += [f't = ({self.word()} + x) & 0xffff',
+                          f'pc = {self.load("t")} + ({self.load("(t + 1) & 0xffff")} << 8)']
+        elif name == 'JSR':
+            lines += ['r = (pc + 1) & 0xffff']
+            lines += self.push('r >> 8') + self.push('r & 0xff')
+            lines += [f'pc = {self.word()}']
+        elif name == 'RTS':
+            lines += self.pop('lo') + self.pop('hi') + ['pc = lo + (hi << 8) + 1']
+        elif name == 'RTI':
+            lines += self.pop('v') + ['p = v | 0x30'] + self.lazy_nz()
+            lines += self.pop('lo') + self.pop('hi') + ['pc = lo + (hi << 8)']
+        elif name == 'BRK':
+            lines += ['r = (pc + 1) & 0xffff']
+            lines += self.push('r >> 8') + self.push('r & 0xff')
+            lines += self.materialize_nz() + ['p |= 0x10'] + self.push('p | 0x30') + ['p |= 0x04']
+            lines += [f'pc = {self.load("0xfffe")} + ({self.load("0xffff")} << 8)']
+            if self.mpu.CMOS:
+                lines += ['p &= 0xf7']
+        else:
+            raise KeyError(name)
+        return lines, 'pc & 0xffff'
+
+    def static_control(self, name, mode):
+        """control() for a known address: targets are worked out here."""
+        address, operands = self.address, self.operands
+        lines = []
+        if name in self.BRANCHES or name == 'BRA':
+            # same arithmetic as BranchRelAddr, on the unmasked pc
+            pc = ((address + 1) & 0xffff) + 1
+            o = operands[0]
+            target = pc - (o ^ 0xff) - 1 if o & 0x80 else pc + o
+            taken = 2 if (pc ^ target) & 0xff00 else 1
+            target &= 0xffff
+            if name == 'BRA':
+                return [f'cyc += {taken}'], f'0x{target:04x}'
+            flag, when_set = self.BRANCHES[name]
+            test = self.flag_test(flag)
+            lines += [f'if {test}:' if when_set else f'if not ({test}):',
+                      f'    cyc += {taken}',
+                      f'    pc = 0x{target:04x}',
+                      'else:',
+                      f'    pc = 0x{pc & 0xffff:04x}']
+        elif name == 'JMP':
+            t = operands[0] | (operands[1] << 8)
+            if mode == 'abs':
+                return lines, f'0x{t:04x}'
+            elif mode == 'ind':
+                if self.mpu.CMOS:
+                    hi = (t + 1) & 0xffff
+                else:
+                    hi = (t & 0xff00) + ((t + 1) & 0xff)
+                lines += [f'pc = {self.load(f"0x{t:04x}")} + ({self.load(f"0x{hi:04x}")} << 8)']
+            else:
+                lines += [f't = (0x{t:04x} + x) & 0xffff',
+                          f'pc = {self.load("t")} + ({self.load("(t + 1) & 0xffff")} << 8)']
+        elif name == 'JSR':
+            r = (address + 2) & 0xffff
+            lines += self.push(f'0x{r >> 8:02x}') + self.push(f'0x{r & 0xff:02x}')
+            return lines, self.word()
+        elif name == 'BRK':
+            r = (address + 2) & 0xffff
+            lines += self.push(f'0x{r >> 8:02x}') + self.push(f'0x{r & 0xff:02x}')
+            lines += self.materialize_nz() + ['p |= 0x10'] + self.push('p | 0x30') + ['p |= 0x04']
+            lines += [f'pc = {self.load("0xfffe")} + ({self.load("0xffff")} << 8)']
+            if self.mpu.CMOS:
+                lines += ['p &= 0xf7']
+        else:
+            # RTS and RTI do not depend on the address
+            self.address = None
+            return self.control(name, mode)
+        return lines, 'pc'
+
+    # Per-opcode handlers
+
+    def handler_source(self, opcode):
+        """Source for a fast_instruct handler: def _op_xx(cpu, pc)."""
+        lines, next_pc = self.compile(opcode)
+        body = '\n'.join(lines)
+        used = [r for r in self.REGISTERS if re.search(rf'\b{r}\b', body)]
+        assigned = [r for r in used if re.search(rf'(^|:)\s*{r} \S?= ', body, re.M)]
+        cycles = self.mpu.cycletime[opcode]
+        src = [f'def _op_{opcode:02x}(cpu, pc):']
+        for local, attr in self.MEMORY.items():
+            if re.search(rf'\b{local}\b', body):
+                src.append(f'    {local} = cpu.{attr}')
+        src += [f'    {r} = cpu.{r}' for r in used]
+        if 'cyc' in body:
+            src.append(f'    cyc = {cycles}')
+        src += ['    ' + line for line in lines]
+        src += [f'    cpu.{r} = {r}' for r in assigned]
+        src.append(f'    cpu.pc = {next_pc}')
+        if 'cyc' in body:
+            src.append('    cpu.processorCycles += cyc')
+        elif cycles:
+            src.append(f'    cpu.processorCycles += {cycles}')
+        return '\n'.join(src)
+
+    def fallback_handler(self, opcode):
+        """Wraps an instruct entry that has no template in step() semantics."""
+        mpu = self.mpu
+        def handler(cpu, pc):
+            cpu.pc = pc
+            cpu.excycles = 0
+            cpu.addcycles = mpu.extracycles[opcode]
+            mpu.instruct[opcode](cpu)
+            cpu.pc &= cpu.addrMask
+            cpu.processorCycles += mpu.cycletime[opcode] + cpu.excycles
+        return handler
+
+    def build_handlers(self):
+        """Compiles the 256 fast_instruct handlers of the MPU class."""
+        namespace = dict(ALU_TABLES)
+        handlers = []
+        for opcode in range(256):
+            try:
+                src = self.handler_source(opcode)
+            except KeyError:
+                handlers.append(self.fallback_handler(opcode))
+                continue
+            exec(compile(src, f'<{self.mpu.__name__} ${opcode:02x}>', 'exec'), namespace)
+            handlers.append(namespace[f'_op_{opcode:02x}'])
+        return handlers
+
+    # Translated blocks
+
+    def block_source(self, cpu, entry):
+        """
+        Translates the code at entry, up to the next instruction loading pc,
+        into a _block function. Returns (source, pages of the code) or (None, ()).
+        """
+        mpu, ram, read_map = self.mpu, cpu.ram, cpu.read_map
+        body, pages, names = [], set(), []
+        pc, cycles, count = entry, 0, 0
+        exit_pc = None
+        code_page = lambda addr: addr > 0x1ff and read_map[addr >> 8] is None
+        while count < self.BLOCK_LIMIT and code_page(pc):
+            opcode = ram[pc]
+            name, mode = mpu.disassemble[opcode]
+            addrs = [(pc + i) & 0xffff for i in range(1, self.LENGTHS[mode])]
+            if not all(map(code_page, addrs)):
+                break
+            try:
+                lines, next_pc = self.compile(opcode, pc, [ram[addr] for addr in addrs], cycles)
+            except KeyError:
+                break
+            pages.update(addr >> 8 for addr in [pc] + addrs)
+            names.append((name, mode, [ram[addr] for addr in addrs]))
+            body.append(f'# ${pc:04x} {name} {mode}')
+            body += lines
+            cycles += mpu.cycletime[opcode]
+            count += 1
+            if name in self.ENDS_BLOCK:
+                exit_pc = next_pc
+                break
+            if any('w = 1' in line for line in lines):
+                # a store went to a write handler, maybe one for translated code
+                body.append(f'if w: return ({next_pc}, a, x, y, sp, p, nz, cyc + {cycles})')
+            pc = int(next_pc, 16)
+        if not count:
+            return None, ()
+        if exit_pc is None:
+            exit_pc = f'0x{pc:04x}'
+        if self.poll_loop(cpu, names):
+            body += [f'if pc == 0x{entry:04x}:',
+                     f'    cpu.poll_cycles = cyc + {cycles}',
+                     "    cpu.stop_reason = 'poll'"]
+        src = ['def _block(a, x, y, sp, p, nz):', '    cyc = 0']
+        if any('w = 1' in line for line in body):
+            src.append('    w = 0')
+        src += ['    ' + line for line in body]
+        src.append(f'    return ({exit_pc}, a, x, y, sp, p, nz, cyc + {cycles})')
+        return '\n'.join(src), pages
+
+    def code(self, src, entry):
+        """Compiles block source, sharing the code object between machines."""
+        code = self.code_cache.get(src)
+        if code is None:
+            if len(self.code_cache) >= self.CODE_CACHE_SIZE:
+                self.code_cache.clear()
+            code = self.code_cache[src] = compile(src, f'<block ${entry:04x}>', 'exec')
+        return code
+
+    def poll_loop(self, cpu, names):
+        if len(names) != 2:
+            return False
+        (name, mode, operands), (branch, _, offset) = names
+        return (name in self.POLL_READS and mode == 'abs' and branch in self.BRANCHES
+                and operands[0] | (operands[1] << 8) in cpu.poll_addresses
+                and offset == [0xfb]) # back to the read
+
+MPU6502.compiler = InstructionCompiler(MPU6502)
+MPU6502.fast_instruct = MPU6502.compiler.build_handlers()
+MPU65C02.compiler = InstructionCompiler(MPU65C02)
+MPU65C02.fast_instruct = MPU65C02.compiler.build_handlers()
+
 # --- Memory Bus Adapter ---
 
 class MemoryBus:
@@ -1695,6 +2633,9 @@ class MemoryBus:
     """
     def __init__(self, system):
         self.system = system
+        self.ram = system.memory
+        self.read_map = system.read_map
+        self.write_map = system.write_map
 
     def __getitem__(self, addr):
         # MPU expects byte at address
@@ -1709,9 +2650,316 @@ class MemoryBus:
 
 # --- Apple-1 System Emulator ---
 
+class Screen:
+    """
+    The 40x24 character display, which front ends draw from: a ring of rows,
+    so scrolling blanks one row instead of moving the rest.
+    """
+    COLUMNS = 40
+    ROWS = 24
+    BLANK = 0x20
+    SAVE_MAGIC = b'SCR' # save() is this, row, column, then the rows
+    SAVE_SIZE = 1000 # bytes at the end of an old save state for the screen, padded
+
+    def __init__(self):
+        self.rows = [bytearray([self.BLANK]) * self.COLUMNS for _ in range(self.ROWS)]
+        self.top = 0 # index in rows of the top row
+        self.row = 0
+        self.column = 0
+        self.line = self.rows[0] # the cursor's row
+
+    def put(self, char):
+        """Writes a 7-bit character code at the cursor: CR, or a printable character."""
+        if char > 0x1F:
+            self.line[self.column] = char
+            self.column += 1
+            if self.column == self.COLUMNS:
+                self.newline()
+        elif char == 0x0D:
+            self.newline()
+
+    def newline(self):
+        self.column = 0
+        if self.row < self.ROWS - 1:
+            self.row += 1
+        else:
+            # scroll: the old top row becomes the new bottom row
+            self.rows[self.top][:] = bytes([self.BLANK]) * self.COLUMNS
+            self.top = (self.top + 1) % self.ROWS
+        self.line = self.rows[(self.top + self.row) % self.ROWS]
+
+    def lines(self):
+        """The rows from top to bottom, as character codes."""
+        return [bytes(self.rows[(self.top + i) % self.ROWS]) for i in range(self.ROWS)]
+
+    def text(self):
+        """The screen as it looks, one line per row."""
+        return '\n'.join(line.translate(CONSOLE_CHARSET).decode('ascii') for line in self.lines())
+
+    def replay(self):
+        """Character codes that draw this screen on a blank one."""
+        lines = self.lines()
+        for line in lines[:self.row]:
+            line = line.rstrip(bytes([self.BLANK]))
+            yield from line
+            if len(line) < self.COLUMNS:
+                yield 0x0D
+        yield from lines[self.row][:self.column]
+
+    def save(self):
+        return self.SAVE_MAGIC + bytes([self.row, self.column]) + b''.join(self.lines())
+
+    @classmethod
+    def load(cls, data):
+        """
+        The screen from save(), or from the last display output that older
+        save states end with, written onto a blank screen.
+        """
+        screen = cls()
+        if data.startswith(cls.SAVE_MAGIC) and len(data) >= 5 + cls.ROWS * cls.COLUMNS:
+            screen.row, screen.column = min(data[3], cls.ROWS - 1), min(data[4], cls.COLUMNS - 1)
+            for i in range(cls.ROWS):
+                screen.rows[i][:] = data[5 + i * cls.COLUMNS:5 + (i + 1) * cls.COLUMNS]
+            screen.line = screen.rows[screen.row]
+        else:
+            for char in data:
+                screen.put(char & 0x7F)
+        return screen
+
+
+def write_parts(f, parts):
+    """Writes parts (bytes-like objects) to the file f, with os.writev() where there is one, so they aren't joined first."""
+    if not hasattr(os, 'writev'):
+        for part in parts:
+            f.write(part)
+        return
+    f.flush()
+    parts = [memoryview(part).cast('B') for part in parts]
+    while parts:
+        written = os.writev(f.fileno(), parts)
+        while parts and written >= len(parts[0]):
+            written -= len(parts.pop(0))
+        if parts:
+            parts[0] = parts[0][written:]
+
+def pack_state(name, sections):
+    """The parts of a save state file of an MPU named name, from (tag, a list of parts) sections."""
+    parts = [Apple1System.STATE_HEADER.pack(Apple1System.STATE_MAGIC, Apple1System.STATE_VERSION, name.encode(), len(sections))]
+    for tag, data in sections:
+        parts.append(Apple1System.STATE_SECTION.pack(tag, sum(len(part) for part in data)))
+        parts += data
+    return parts
+
+def read_state_file(file_path):
+    """The MPU name and the {tag: data} sections of a save state file."""
+    with open(file_path, 'rb') as f:
+        return unpack_state(f.read(), file_path)
+
+def unpack_state(data, file_path='the save state'):
+    """The MPU name and the {tag: data} sections of a save state."""
+    header, section = Apple1System.STATE_HEADER, Apple1System.STATE_SECTION
+    if not data.startswith(Apple1System.STATE_MAGIC) or len(data) < header.size:
+        raise ValueError(f'{file_path} is not a save state (or is one from before versions)')
+    magic, version, name, count = header.unpack_from(data)
+    if not 1 <= version <= Apple1System.STATE_VERSION:
+        raise ValueError(f'{file_path} is save state version {version}, which is not supported')
+    sections = {}
+    at = header.size
+    for _ in range(count):
+        if at + section.size > len(data):
+            raise ValueError(f'{file_path} is cut short')
+        tag, size = section.unpack_from(data, at)
+        at += section.size
+        if at + size > len(data):
+            raise ValueError(f'{file_path} is cut short')
+        sections[tag] = data[at:at + size]
+        at += size
+    return name.rstrip(b'\0').decode('ascii', 'replace'), sections
+
+def compact_states(file_paths, output):
+    """
+    Writes the state a chain of save states ends in, a full one and then
+    deltas (each on the one before), to output as one full save state.
+    """
+    name, sections = read_state_file(file_paths[0])
+    if b'RAM ' not in sections:
+        raise ValueError(f'{file_paths[0]} is a delta, the chain starts with a full save state')
+    memory = bytearray(sections[b'RAM '])
+    for file_path in file_paths[1:]:
+        delta_name, delta = read_state_file(file_path)
+        if b'PAGE' not in delta or delta.get(b'BASE') != sections.get(b'ID  ') or delta_name != name:
+            raise ValueError(f'{file_path} is not a delta on the save state before it')
+        pages = delta[b'PAGE']
+        count = Apple1System.STATE_PAGES.unpack_from(pages)[0]
+        at = Apple1System.STATE_PAGES.size + count
+        for page in pages[Apple1System.STATE_PAGES.size:at]:
+            memory[page << 8:(page + 1) << 8] = pages[at:at + 256]
+            at += 256
+        sections = delta
+    # the last one's state, and its id: deltas on it load on this too
+    sections = [(b'RAM ', [memory]) if tag in (b'RAM ', b'PAGE') else (tag, [data]) for tag, data in sections.items() if tag != b'BASE']
+    with open(output, 'wb') as f:
+        write_parts(f, pack_state(name, sections))
+
+class StateStore:
+    """
+    Save states in a directory, stored by content: each distinct RAM page is
+    kept once in a pack file, and a save state is a manifest of page hashes.
+    """
+    RECORD = struct.Struct('<16sH') # page hash, stored length, then the page: compressed, unless the length is 256
+    PAGE_IDS = struct.Struct('<H') # count of distinct page hashes, then the hashes, then each page's index in them
+    CACHE_SIZE = 4096 # decompressed pages kept for loading
+
+    def __init__(self, directory, level=6):
+        """level is the zlib compression level for new pages."""
+        self.directory = directory
+        self.level = level
+        os.makedirs(os.path.join(directory, 'manifests'), exist_ok=True)
+        self.pages = {} # hash -> (offset, length) of the stored page in the pack
+        self.cache = {} # hash -> page
+        self.pack = open(os.path.join(directory, 'pages.pack'), 'a+b')
+        self.pack.seek(0)
+        data = self.pack.read()
+        at = 0
+        while at + self.RECORD.size <= len(data):
+            digest, size = self.RECORD.unpack_from(data, at)
+            if at + self.RECORD.size + size > len(data):
+                break
+            self.pages[digest] = (at + self.RECORD.size, size)
+            at += self.RECORD.size + size
+        if at < len(data):
+            self.pack.truncate(at) # a record that didn't get all written
+        self.end = at
+
+    def path(self, name):
+        if not name or name.startswith('.') or os.path.basename(name) != name:
+            raise ValueError(f'{name!r} can not be a save state name')
+        return os.path.join(self.directory, 'manifests', name + '.state')
+
+    def names(self):
+        return sorted(entry[:-len('.state')] for entry in os.listdir(os.path.join(self.directory, 'manifests')) if entry.endswith('.state'))
+
+    def delete(self, name):
+        os.remove(self.path(name))
+
+    def save(self, system, name):
+        """Stores a save state of system as name; it's a checkpoint, see Apple1System.state_parts()."""
+        self.store(name, system.cpu.name, system.state_sections())
+
+    def put(self, name, state):
+        """Stores a full save state (from Apple1System.snapshot()) as name."""
+        mpu_name, sections = unpack_state(state)
+        self.store(name, mpu_name, [(tag, [data]) for tag, data in sections.items()])
+
+    def store(self, name, mpu_name, sections):
+        path = self.path(name)
+        manifest = []
+        for tag, data in sections:
+            if tag != b'RAM ':
+                manifest.append((tag, data))
+                continue
+            memory = memoryview(b''.join(data))
+            if len(memory) != 0x10000:
+                raise ValueError('the save state has no full RAM')
+            ids = {} # hash -> index
+            index = bytearray(256)
+            for page in range(256):
+                content = memory[page << 8:(page + 1) << 8]
+                digest = hashlib.blake2b(content, digest_size=16).digest()
+                if digest not in self.pages:
+                    stored = zlib.compress(content, self.level)
+                    if len(stored) >= 256:
+                        stored = content
+                    self.pack.write(self.RECORD.pack(digest, len(stored)))
+                    self.pack.write(stored)
+                    self.pages[digest] = (self.end + self.RECORD.size, len(stored))
+                    self.end += self.RECORD.size + len(stored)
+                index[page] = ids.setdefault(digest, len(ids))
+            manifest.append((b'PGID', [self.PAGE_IDS.pack(len(ids)), *ids, index]))
+        if not any(tag == b'PGID' for tag, data in manifest):
+            raise ValueError('a delta can not be stored, only a full save state')
+        # the pages go to disk before a manifest can refer to them
+        self.pack.flush()
+        with open(path + '.new', 'wb') as f:
+            write_parts(f, pack_state(mpu_name, manifest))
+        os.replace(path + '.new', path)
+
+    def page(self, digest):
+        content = self.cache.get(digest)
+        if content is None:
+            if len(self.cache) >= self.CACHE_SIZE:
+                self.cache.clear()
+            offset, size = self.pages[digest]
+            self.pack.seek(offset)
+            content = self.pack.read(size)
+            if size != 256:
+                content = zlib.decompress(content)
+            self.cache[digest] = content
+        return content
+
+    def manifest(self, name):
+        # (MPU name, sections, the pages from the hash list)
+        path = self.path(name)
+        mpu_name, sections = read_state_file(path)
+        page_ids = sections.pop(b'PGID', None)
+        if page_ids is None:
+            raise ValueError(f'{path} has no page list')
+        count = self.PAGE_IDS.unpack_from(page_ids)[0]
+        at = self.PAGE_IDS.size
+        hashes = [page_ids[at + i * 16:at + (i + 1) * 16] for i in range(count)]
+        try:
+            contents = [self.page(digest) for digest in hashes]
+        except KeyError:
+            raise ValueError(f'{path} refers to pages that are not in the pack') from None
+        index = page_ids[at + count * 16:]
+        return mpu_name, sections, [contents[i] for i in index]
+
+    def load(self, system, name):
+        """Loads the save state name into system, its pages straight into memory."""
+        mpu_name, sections, pages = self.manifest(name)
+        if mpu_name != system.cpu.name:
+            raise ValueError(f'the save state is of a {mpu_name}, not a {system.cpu.name}')
+        memory = system.memory
+        for page, content in enumerate(pages):
+            memory[page << 8:(page + 1) << 8] = content
+        # the rest is a save state without RAM, which leaves memory as it is
+        system.restore(b''.join(pack_state(mpu_name, [(tag, [data]) for tag, data in sections.items()])))
+
+    def get(self, name):
+        """The save state name, as a full save state."""
+        mpu_name, sections, pages = self.manifest(name)
+        state = [(tag, [data]) for tag, data in sections.items()]
+        state.insert(list(sections).index(b'CPU ') + 1, (b'RAM ', pages))
+        return b''.join(pack_state(mpu_name, state))
+
+    def close(self):
+        self.pack.close()
+
 class Apple1System:
-    def __init__(self, mpu, display_callback, raw_display, no_aci, network, fast_display, alt_display, bench):
+    DISPLAY_RATE = 60.05 # characters per second the display takes
+
+    # Save states: a header, then sections of a tag, a length and the data.
+    # A loader skips sections it doesn't know; VERSION changes when a known
+    # one changes, or one is added that a loader can't do without (2: deltas).
+    STATE_MAGIC = b'A1SS'
+    STATE_VERSION = 2
+    STATE_HEADER = struct.Struct('<4sB6sB') # magic, version, MPU name, section count
+    STATE_SECTION = struct.Struct('<4sI') # tag, length
+    STATE_CPU = struct.Struct('<HBBBBBQB') # pc, a, x, y, sp, p, cycles, waiting (65C02 WAI)
+    STATE_PIA = struct.Struct('<BBQII') # dsp, dspcr, dsp_clock, then the lengths of kbd and dsp_buffer, which follow
+    STATE_NET = struct.Struct('<BII') # busy, then the lengths of the URL so far and of the response waiting, which follow
+    STATE_PAGES = struct.Struct('<H') # count, then the page numbers and the pages
+
+    def __init__(self, mpu, display_callback=None, raw_display=False, no_aci=False, network=False, fast_display=False, alt_display=False, bench=False,
+                 engine='translated', roms=(), frontend=None, net_session=None, mhz=1.023, deterministic=False):
+        """
+        frontend provides the keyboard and display (see ConsoleFrontEnd),
+        by default a MemoryFrontEnd; display_callback takes the display output.
+        """
         self.memory = bytearray(65536)
+        self.read_map = [None] * 256 # page -> read handler, None for plain RAM/ROM
+        self.write_map = [None] * 256 # page -> write handler, None for plain RAM
+        self.rom_pages = bytearray(256) # write-protect mask, 1 for ROM pages
 
         # Hardware
         self.cpu = mpu
@@ -1720,39 +2968,53 @@ class Apple1System:
         # ROM
         self.wozmon = None
         self.exp = None
+        self.extra_roms = list(roms) # (address, data) images from --rom
+        self.roms = []
 
         # Variables
-        self.display_callback = display_callback
+        self.frontend = MemoryFrontEnd() if frontend is None else frontend
+        self.display_callback = self.frontend.display if display_callback is None else display_callback
         self.raw_display = raw_display
         self.alt_display = alt_display
         self.no_aci = no_aci
         self.network = network
         self.fast_display = fast_display
-        self.char_in_line = 0
-        self.init_terminal, self.reset_terminal = setup_console(self)
+        self.screen = Screen()
+        self.events = deque() # actions posted by the keyboard thread, run between slices
+        self.input_event = threading.Event() # set when a key, network data or an event arrives
+        self.deterministic = deterministic # no threads: network responses are fetched as the URL is sent
         self.bench = bench
         self.terminated = False
-        self.dsp_mem = bytearray()
+        self.state_id = None # of the last checkpoint, the save state deltas load on (see state_parts())
 
         # PIA
-        self.kbd = bytearray()
+        self.kbd = deque() # keys typed ahead, the keyboard thread appends to it
         self.dsp = 0x00
         self.dspcr = False # True when display ready (set to True when $7F received)
-        self.dsp_clock = 0
+        self.dsp_clock = 0 # cycle count at which the display takes the next character
+        self.dsp_cycles = round(mhz * 1e6 / self.DISPLAY_RATE) # cycles per character at the clock speed
         self.dsp_buffer = deque()
 
         if self.network:
             # Networking State
-            self.net_session = Session()
+            self.net_session = Session() if net_session is None else net_session
             self.net_url_buffer = []
             self.net_response_queue = deque()
             self.net_busy = False
 
         self.load_roms()
-        self.cpu = self.cpu(memory=self.mem_bus)
+        self.cpu = self.cpu(memory=self.mem_bus, engine=engine)
+
+        # Status registers polled in busy-wait loops (bench measures the loops themselves)
+        if not bench:
+            self.cpu.poll_addresses.update((0xD011, 0xD012))
+            if self.network:
+                self.cpu.poll_addresses.update((0xD015, 0xD016))
+
+        self.frontend.attach(self)
 
     def _network_fetch(self, url):
-        """Internal helper to fetch data in a separate thread."""
+        """Internal helper to fetch data, in a separate thread unless deterministic."""
         try:
             # Fetch the content
             self.net_response_queue = deque()
@@ -1760,11 +3022,13 @@ class Apple1System:
 
             for char in response.iter_content():
                 self.net_response_queue.append(ord(char)) 
+                self.input_event.set()
         except:
             pass
         finally:
             self.net_response_queue.append(0x03)
             self.net_busy = False
+            self.input_event.set()
 
     def load_roms(self):
         # Load Wozmon
@@ -1778,10 +3042,45 @@ class Apple1System:
             # Load Network Interface
             self.exp = NET_DATA
 
+        # The expansion ROM appears at both $C000 and $C100
+        self.roms = [(0xFF00, self.wozmon)]
+        if self.exp:
+            self.roms += [(0xC000, self.exp), (0xC100, self.exp)]
+        self.roms += self.extra_roms
+        self.map_roms()
+
+        # Device pages (plain RAM and ROM pages have no read handlers)
+        self.read_map[0xD0] = self.read_pia
+        self.write_map[0xD0] = self.write_pia
+        if self.exp:
+            # ACI triggers
+            self.read_map[0xC0] = self.read_expansion
+            self.write_map[0xC0] = self.write_expansion
+
+    def map_roms(self):
+        # Copies the ROM images into memory and write-protects their pages
+        for addr, data in self.roms:
+            data = data[:0x10000 - addr]
+            self.memory[addr:addr + len(data)] = data
+            for page in range(addr >> 8, (addr + len(data) + 0xFF) >> 8):
+                self.rom_pages[page] = 1
+                self.write_map[page] = self.write_rom
+
     def read(self, addr):
+        handler = self.read_map[addr >> 8]
+        return self.memory[addr] if handler is None else handler(addr)
+
+    def write(self, addr, value):
+        handler = self.write_map[addr >> 8]
+        if handler is None:
+            self.memory[addr] = value
+        else:
+            handler(addr, value)
+
+    def read_pia(self, addr):
         # PIA Keyboard
         if addr == 0xD010:
-            return self.kbd.pop(0) if self.kbd else 0x00
+            return self.kbd.popleft() if self.kbd else 0x00
         elif addr == 0xD011:
             return 0x80 if self.kbd else 0x00
 
@@ -1790,7 +3089,7 @@ class Apple1System:
             if self.fast_display or self.alt_display:
                 return 0x00
             else:
-                if self.dsp: self.dsp = 0x80 if time() < self.dsp_clock else 0x00
+                if self.dsp: self.dsp = 0x80 if self.cpu.processorCycles < self.dsp_clock else 0x00
                 return self.dsp
         elif addr == 0xD013:
             return 0x00 # Not intended to be read
@@ -1803,50 +3102,21 @@ class Apple1System:
         elif addr == 0xD016 and self.network:
             return 0x80 if self.net_busy else 0x00
 
-        # ACI Load Trigger
-        elif addr == 0xC081 and not self.no_aci:
-            # Wozmon stores destination address at $24,$25
-            dest_addr = self.memory[0x24] | (self.memory[0x25] << 8)
-
-            if tkinter_available:
-                file_path = filedialog.askopenfilename(filetypes=[("Binary file", "*.bin"), ("All files", "*.*")])
-            else:
-                self.reset_terminal()
-                file_path = input('Input a binary file to load: ')
-                self.init_terminal()
-            if file_path:
-                try:
-                    with open(file_path, "rb") as f:
-                        data = f.read()
-                        # Write data into emulator memory
-                        for i, byte in enumerate(data):
-                            if dest_addr + i < 0x10000: self.memory[dest_addr + i] = byte
-                        print(f"Loaded {len(data)} bytes from {file_path}")
-                except Exception as e:
-                    print(f"Load failed: {e}")
-            return 0 # Return dummy value
-
-        elif addr >= 0xC000 and addr <= 0xC0FF and self.exp:
-            return self.exp[addr - 0xC000] if addr - 0xC000 < len(self.exp) else 0x00
-        elif addr >= 0xC100 and addr <= 0xC1FF and self.exp:
-            return self.exp[addr - 0xC100] if addr - 0xC100 < len(self.exp) else 0x00
-
-        elif addr >= 0xFF00 and addr <= 0xFFFF and self.wozmon:
-            return self.wozmon[addr - 0xFF00] if addr - 0xFF00 < len(self.wozmon) else 0x00
-
         return self.memory[addr]
 
-    def write(self, addr, value):
+    def write_pia(self, addr, value):
         # PIA Display
         if addr == 0xD012:
             if self.dspcr and not self.dsp:
                 if self.alt_display:
                     self.dsp_buffer.append(value)
                 else:
-                    self.display_callback(self, value, self.raw_display)
-                    if not self.fast_display:
+                    self.display(value)
+                    # with keys typed ahead (a paste) the display doesn't
+                    # hold the CPU up, so they go in as fast as they're read
+                    if not self.fast_display and not self.kbd:
                         self.dsp = 0x80
-                        self.dsp_clock = time() + 1 / 60.05
+                        self.dsp_clock = self.cpu.poll_wake = self.cpu.processorCycles + self.dsp_cycles
             return
 
         if addr == 0xD013:
@@ -1860,65 +3130,246 @@ class Apple1System:
                     url = "".join(self.net_url_buffer).lower()
                     self.net_url_buffer = [] # Clear buffer for next time
                     self.net_busy = True
-                    # Start fetch in a background thread
-                    threading.Thread(target=self._network_fetch, args=(url,), daemon=True).start()
+                    if self.deterministic:
+                        # the whole response is there before the next instruction
+                        self._network_fetch(url)
+                    else:
+                        # Start fetch in a background thread
+                        threading.Thread(target=self._network_fetch, args=(url,), daemon=True).start()
                 else:
                     # Build the URL string
                     self.net_url_buffer.append(chr(value))
             return
 
+        self.memory[addr] = value
+
+    def read_expansion(self, addr):
+        # ACI Load Trigger
+        if addr == 0xC081 and not self.no_aci:
+            # Wozmon stores destination address at $24,$25
+            dest_addr = self.memory[0x24] | (self.memory[0x25] << 8)
+
+            file_path = self.frontend.choose_file(save=False)
+            if file_path:
+                try:
+                    with open(file_path, "rb") as f:
+                        data = f.read()
+                        # Write data into emulator memory
+                        for i, byte in enumerate(data):
+                            if dest_addr + i < 0x10000 and not self.rom_pages[(dest_addr + i) >> 8]: self.memory[dest_addr + i] = byte
+                        for page in range(dest_addr >> 8, min(dest_addr + len(data) + 0xFF, 0x10000) >> 8):
+                            self.cpu.untrack_page(page)
+                        self.cpu.flush_blocks()
+                        print(f"Loaded {len(data)} bytes from {file_path}")
+                except Exception as e:
+                    print(f"Load failed: {e}")
+            return 0 # Return dummy value
+
+        return self.memory[addr]
+
+    def write_expansion(self, addr, value):
         # ACI Save Trigger
-        elif addr == 0xC028 and not self.no_aci:
+        if addr == 0xC028 and not self.no_aci:
             start_addr = self.memory[0x26] | (self.memory[0x27] << 8)
             end_addr = self.memory[0x24] | (self.memory[0x25] << 8)
 
             # Ensure the end is after the start
             if end_addr >= start_addr:
-                if tkinter_available:
-                    file_path = filedialog.asksaveasfilename(filetypes=[("Binary file", "*.bin"), ("All files", "*.*")])
-                else:
-                    self.reset_terminal()
-                    file_path = input('Input a binary file to save: ')
-                    self.init_terminal()
+                file_path = self.frontend.choose_file(save=True)
                 if file_path:
                     try:
                         with open(file_path, "wb") as f: f.write(self.memory[start_addr:end_addr + 1])
                         print(f"Saved {end_addr - start_addr + 1} bytes to {file_path}")
                     except Exception as e:
                         print(f"Save failed: {e}")
-            return
 
-        # RAM
+    def write_rom(self, addr, value):
+        pass # ROM pages ignore writes
+
+    def state_parts(self, delta=False, checkpoint=True):
+        """The save state, as a list of parts for write_parts(), see state_sections()."""
+        return pack_state(self.cpu.name, self.state_sections(delta, checkpoint))
+
+    def state_sections(self, delta=False, checkpoint=True):
+        """
+        The save state, as (tag, a list of parts) sections, the RAM as views of
+        memory. A delta has only the pages written since the last checkpoint.
+        """
+        cpu = self.cpu
+        memory = memoryview(self.memory)
+        sections = []
+        if delta and self.state_id:
+            pages = self.written_pages()
+            sections.append((b'BASE', [self.state_id]))
+        sections.append((b'CPU ', [self.STATE_CPU.pack(cpu.pc, cpu.a, cpu.x, cpu.y, cpu.sp, cpu.p, cpu.processorCycles, getattr(cpu, 'waiting', False))]))
+        if delta and self.state_id:
+            sections.append((b'PAGE', [self.STATE_PAGES.pack(len(pages)), bytes(pages)] + [memory[page << 8:(page + 1) << 8] for page in pages]))
         else:
-            self.memory[addr] = value
-            return
-
-    def save_state(self):
-        state = b''
-        if self.cpu.pc < 256:
-            state += bytes([0x00, self.cpu.pc])
-        else:
-            state += bytes([self.cpu.pc // 256, self.cpu.pc % 256])
-        state += bytes([self.cpu.a, self.cpu.x, self.cpu.y, self.cpu.sp, self.cpu.p])
-        state += bytes(self.memory)
-        self.dsp_mem = self.dsp_mem.replace(b'\n', b'')
-        state += bytes(bytes(1000 - len(self.dsp_mem)) + self.dsp_mem)
-        with open(f'save_state_{int(time())}.bin', 'wb') as f:
-            f.write(state)
+            sections.append((b'RAM ', [memory]))
+        sections += [
+            (b'PIA ', [self.STATE_PIA.pack(self.dsp, self.dspcr, self.dsp_clock, len(self.kbd), len(self.dsp_buffer)), bytes(self.kbd), bytes(self.dsp_buffer)]),
+            (b'SCRN', [self.screen.save()]),
+        ]
+        if self.network:
+            url = ''.join(self.net_url_buffer).encode('latin-1')
+            response = bytes(self.net_response_queue)
+            sections.append((b'NET ', [self.STATE_NET.pack(self.net_busy, len(url), len(response)), url, response]))
+        # the id is a hash of the whole state, so the same state always saves the same
+        digest = hashlib.blake2b(memory, digest_size=8)
+        for tag, data in sections:
+            if tag not in (b'BASE', b'PAGE', b'RAM '):
+                for part in data:
+                    digest.update(part)
+        state_id = digest.digest()
+        sections.insert(0, (b'ID  ', [state_id]))
+        if checkpoint:
+            self.state_id = state_id
+            cpu.track_writes()
+        elif self.state_id:
+            sections.append((b'DIRT', [self.state_id, bytes(self.written_pages())]))
+        return sections
+
+    def written_pages(self):
+        # RAM pages written since the last checkpoint; ROM pages don't change
+        written = self.cpu.written
+        return [page for page in range(256) if written[page] and not self.rom_pages[page]]
+
+    def snapshot(self, delta=False, checkpoint=True):
+        """The save state as bytes, see state_parts()."""
+        return b''.join(self.state_parts(delta, checkpoint))
+
+    def restore(self, state):
+        """Loads a save state from snapshot() or a save state file's contents."""
+        self.read_state(io.BytesIO(state))
+
+    def save_state(self, filename=None, delta=False):
+        with open(filename or f'save_state_{int(time())}.bin', 'wb') as f:
+            write_parts(f, self.state_parts(delta))
 
     def load_state(self, filename):
         with open(filename, 'rb') as f:
-            self.cpu.pc = int(f.read(2).hex(), 16)
-            self.cpu.a = int(f.read(1).hex(), 16)
-            self.cpu.x = int(f.read(1).hex(), 16)
-            self.cpu.y = int(f.read(1).hex(), 16)
-            self.cpu.sp = int(f.read(1).hex(), 16)
-            self.cpu.p = int(f.read(1).hex(), 16)
-            self.memory = bytearray(f.read(65536))
-            dsp_mem = bytearray(f.read(1000))
-            for value in dsp_mem:
-                self.display_callback(self, value, self.raw_display)
-            self.dspcr = True
+            self.read_state(f)
+
+    def read_state(self, f):
+        """
+        Loads a save state from the binary file f. Raises ValueError, leaving
+        the machine as it was, if it isn't one this can load.
+        """
+        def read(size):
+            data = f.read(size)
+            if len(data) < size:
+                raise ValueError('the save state is cut short')
+            return data
+
+        header = f.read(self.STATE_HEADER.size)
+        if not header.startswith(self.STATE_MAGIC):
+            self.restore_old(header + f.read())
+            return
+        if len(header) < self.STATE_HEADER.size:
+            raise ValueError('the save state is cut short')
+        magic, version, name, count = self.STATE_HEADER.unpack(header)
+        name = name.rstrip(b'\0').decode('ascii', 'replace')
+        if not 1 <= version <= self.STATE_VERSION:
+            raise ValueError(f'save state version {version} is not supported')
+        if name != self.cpu.name:
+            raise ValueError(f'the save state is of a {name}, not a {self.cpu.name}')
+        cpu = self.cpu
+        sections = {}
+        for _ in range(count):
+            tag, size = self.STATE_SECTION.unpack(read(self.STATE_SECTION.size))
+            sections[tag] = read(size)
+
+        # everything is read and checked before the machine changes
+        ram = sections.get(b'RAM ')
+        if ram is not None and len(ram) != len(self.memory):
+            ram = None
+        base, data = sections.get(b'BASE'), sections.get(b'PAGE')
+        pages = None
+        if base is not None and base != self.state_id:
+            raise ValueError('the save state is a delta on another one than this machine last saved or loaded')
+        if data is not None:
+            if base is None:
+                raise ValueError('the save state has pages but no base')
+            number = self.STATE_PAGES.unpack_from(data)[0] if len(data) >= self.STATE_PAGES.size else -1
+            if len(data) != self.STATE_PAGES.size + number * 257:
+                raise ValueError('the save state is cut short')
+            at = self.STATE_PAGES.size + number
+            pages, contents = data[self.STATE_PAGES.size:at], data[at:]
+            # pages written since the checkpoint that the delta doesn't overwrite would mix two states
+            if not set(self.written_pages()) <= set(pages):
+                raise ValueError('the machine has written pages since the save state the delta is on')
+        try:
+            registers = sections.get(b'CPU ') and self.STATE_CPU.unpack_from(sections[b'CPU '])
+            pia = sections.get(b'PIA ') and self.STATE_PIA.unpack_from(sections[b'PIA '])
+            net = self.network and sections.get(b'NET ') and self.STATE_NET.unpack_from(sections[b'NET '])
+        except struct.error:
+            raise ValueError('the save state is cut short') from None
+        screen = sections.get(b'SCRN') and Screen.load(sections[b'SCRN'])
+        dirt = sections.get(b'DIRT')
+
+        if ram is not None:
+            self.memory[:] = ram
+        if pages is not None:
+            for i, page in enumerate(pages):
+                self.memory[page << 8:(page + 1) << 8] = contents[i << 8:(i + 1) << 8]
+        if registers:
+            cycles = cpu.processorCycles
+            cpu.pc, cpu.a, cpu.x, cpu.y, cpu.sp, cpu.p, cpu.processorCycles, waiting = registers
+            if cpu.profiler: cpu.profiler.rebase(cycles, cpu.processorCycles)
+            if hasattr(cpu, 'waiting'):
+                cpu.waiting = bool(waiting)
+        if pia:
+            data = sections[b'PIA ']
+            self.dsp, dspcr, self.dsp_clock, keys, held = pia
+            self.dspcr = bool(dspcr)
+            keys += self.STATE_PIA.size
+            self.kbd.clear()
+            self.kbd.extend(data[self.STATE_PIA.size:keys])
+            self.dsp_buffer = deque(data[keys:keys + held])
+        if net:
+            data = sections[b'NET ']
+            busy, url, waiting = net
+            url += self.STATE_NET.size
+            self.net_url_buffer = list(data[self.STATE_NET.size:url].decode('latin-1'))
+            self.net_response_queue = deque(data[url:url + waiting])
+            if busy:
+                self.net_response_queue.append(0x03)
+            self.net_busy = False
+        cpu.poll_wake = self.dsp_clock
+        self.map_roms() # the ROMs of this system, not the saved ones
+        cpu.flush_blocks()
+        # it's a checkpoint, unless it carries the one it was saved on
+        self.state_id = sections.get(b'ID  ') if dirt is None else dirt[:8]
+        if self.state_id:
+            cpu.track_writes()
+            for page in (dirt or b'')[8:]:
+                cpu.untrack_page(page)
+        if screen:
+            self.redraw(screen)
+
+    def restore_old(self, state):
+        # Save states from before the versioned format: pc (big-endian), a,
+        # x, y, sp, p, the RAM, then the screen or the last display output
+        if len(state) < 7 + 65536:
+            raise ValueError('not a save state')
+        self.cpu.pc, self.cpu.a, self.cpu.x, self.cpu.y, self.cpu.sp, self.cpu.p = struct.unpack_from('>HBBBBB', state)
+        self.state_id = None
+        self.memory[:] = state[7:7 + 65536]
+        self.map_roms() # older save states have no ROM contents
+        self.cpu.flush_blocks()
+        self.redraw(Screen.load(state[7 + 65536:7 + 65536 + Screen.SAVE_SIZE]))
+        self.dspcr = True
+
+    def redraw(self, screen):
+        # puts screen on the display by writing it out again
+        self.screen = Screen()
+        for value in screen.replay():
+            self.display(value)
+
+    def display(self, char):
+        # a character that made it to the display: onto the screen, then the front end
+        self.screen.put(char & 0x7F)
+        self.display_callback(self, char, self.raw_display)
 
     def key_pressed(self, key, bench):
         if key:
@@ -1933,23 +3384,120 @@ class Apple1System:
                     self.kbd.append(0x5F | 0x80)
             elif ascii_val == 9: # Tab
                 if not bench:
-                    self.reset()
-                    self.dspcr = 0x00
+                    self.post(self.reset_button)
             elif ascii_val == 10: # Ctrl+Enter
                 if not bench:
-                    self.save_state()
+                    self.post(self.save_state)
+            self.input_event.set()
+
+    def paste(self, text):
+        """
+        Types text (str or bytes) ahead, as key_codes() maps it, as fast as
+        the program reads the keys.
+        """
+        if isinstance(text, str):
+            text = text.encode('ascii', 'ignore')
+        self.kbd.extend(key_codes(text))
+        self.input_event.set()
+
+    def reset_button(self):
+        self.reset()
+        self.dspcr = 0x00
+
+    def post(self, action):
+        # The CPU state belongs to the thread running the emulation, so other
+        # threads queue their actions here
+        self.events.append(action)
+        self.input_event.set()
+
+    def run_events(self):
+        while self.events:
+            self.events.popleft()()
+
+    def idle(self):
+        """
+        True when a CPU polling a status register can only be waiting for
+        input: nothing is queued and the display is not busy.
+        """
+        if self.kbd or self.events or self.terminated or (self.network and self.net_response_queue):
+            return False
+        return not (self.dsp_buffer or (self.dsp and self.cpu.processorCycles < self.dsp_clock))
+
+    def waiting_for_input(self, reason):
+        """
+        True when run(), which returned reason, left the CPU polling the
+        keyboard with nothing on the way.
+        """
+        return reason in ('idle', None) and self.idle() and self.cpu.polling() == 0xD011
+
+    def wait_for_event(self, timeout):
+        """
+        Blocks until input or an event arrives or timeout seconds pass, but
+        only while idle() is True; otherwise returns right away.
+        """
+        self.input_event.clear()
+        if self.idle():
+            self.input_event.wait(timeout)
+
+    def update_alt_display(self):
+        # --alt-display: after a slice, shows the next buffered character
+        # once the display is ready for it
+        if self.dsp_buffer and self.cpu.processorCycles >= self.dsp_clock:
+            self.display(self.dsp_buffer.popleft())
+            self.dsp_clock = self.cpu.processorCycles + self.dsp_cycles
 
     def terminate(self):
         self.terminated = True
+        self.input_event.set()
+
+    def close(self):
+        """Detaches the front end; the console gives the terminal back."""
+        self.frontend.detach()
 
     # Passthroughs (use these instead of direct MPU functions)
     def step(self):
         if self.terminated: raise KeyboardInterrupt
         self.cpu.step()
+        self.run_events()
+
+    def run(self, cycles):
+        """Runs the CPU for about the given number of cycles. Returns the MPU's stop reason."""
+        if self.terminated: raise KeyboardInterrupt
+        reason = self.cpu.run(cycles)
+        self.run_events()
+        if self.alt_display:
+            self.update_alt_display()
+        return reason
+
+    def run_until(self, pc=None, predicate=None, max_cycles=None, slice_cycles=1000):
+        """
+        Runs until the CPU reaches pc, predicate(system) is True or max_cycles
+        have run. Returns 'pc', 'predicate', the MPU's stop reason or None.
+        """
+        end = None if max_cycles is None else self.cpu.processorCycles + max_cycles
+        while True:
+            if self.terminated: raise KeyboardInterrupt
+            cycles = slice_cycles if end is None else min(slice_cycles, end - self.cpu.processorCycles)
+            if cycles <= 0:
+                return None
+            if pc is None:
+                reason = self.cpu.run(cycles)
+            else:
+                reason = self.cpu.run_to(pc, cycles)
+            self.run_events()
+            if self.alt_display:
+                self.update_alt_display()
+            if reason and reason != 'idle':
+                return reason
+            if predicate is not None and predicate(self):
+                return 'predicate'
 
     def reset(self):
         if self.terminated: raise KeyboardInterrupt
+        cycles = self.cpu.processorCycles
         self.cpu.reset()
+        if self.cpu.profiler: self.cpu.profiler.rebase(cycles, 0)
+        self.dsp_clock = 0 # the cycle count starts over
         self.net_url_buffer = []
         self.net_response_queue = deque()
         self.net_busy = False
@@ -1961,15 +3509,14 @@ def setup_console(system):
         def get_key():
             try:
                 while True:
-                    if msvcrt.kbhit():
-                        # Get the char and convert to Apple 1 expected format
-                        char = msvcrt.getch()
-                        if char == b'\xe0':
-                            msvcrt.getch()
-                        try:
-                            system.key_pressed(char.decode().upper(), system.bench)
-                        except: pass
-                    sleep(0.0000000001)
+                    # Wait for the char and convert to Apple 1 expected format
+                    char = msvcrt.getch()
+                    if char in (b'\x00', b'\xe0'):
+                        msvcrt.getch() # second half of a function or arrow key
+                        continue
+                    try:
+                        system.key_pressed(char.decode().upper(), system.bench)
+                    except UnicodeDecodeError: pass
             except KeyboardInterrupt:
                 system.terminate()
         # Not needed on Windows
@@ -1980,15 +3527,18 @@ def setup_console(system):
         threading.Thread(target=get_key, daemon=True).start()
         return init_terminal, reset_terminal
     else:
-        import tty, termios, select
+        import tty, termios
         old_settings = termios.tcgetattr(sys.stdin.fileno())
         def get_key():
+            # blocks in os.read() until keys arrive; a paste arrives as one
+            # read, and goes to kbd in one go
             try:
                 while True:
-                    if select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], []):
-                        char = sys.stdin.read(1).upper()
+                    data = os.read(sys.stdin.fileno(), 4096)
+                    if not data:
+                        break
+                    for char in data.decode('latin-1').upper():
                         system.key_pressed(char, system.bench)
-                    sleep(0.0000000001)
             except KeyboardInterrupt:
                 system.terminate()
         def init_terminal():
@@ -2001,65 +3551,1501 @@ def setup_console(system):
         threading.Thread(target=get_key, daemon=True).start()
         return init_terminal, reset_terminal
 
-def console_display(self, char, raw_display):
-    """Translates Apple 1 character codes to the system console."""
-    char = char & 0x7F
-    if char == 0x0D:
-        sys.stdout.write("\r\n")
-        sys.stdout.flush()
-        self.char_in_line = 0
-        self.dsp_mem.append(char)
-        while self.dsp_mem.count(0x0D) + self.dsp_mem.count(0x0A) > 25:
-            self.dsp_mem.pop(0)
-    elif char > 0x1F:
-        # Signetics 2513 character set
-        charset = "                                 !\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_"
-        sys.stdout.write(charset[char])
-        sys.stdout.flush()
-        self.char_in_line += 1
-        self.dsp_mem.append(char)
-        if self.char_in_line >= 40:
-            if not raw_display:
-                sys.stdout.write("\r\n")
-                sys.stdout.flush()
-            self.dsp_mem.append(0x0A)
-            self.char_in_line = 0
-            while self.dsp_mem.count(0x0D) + self.dsp_mem.count(0x0A) > 25:
-                self.dsp_mem.pop(0)
+# Signetics 2513 character set
+SIGNETICS_2513 = b"                                 !\"#$%&'()*+,-./0123456789:;<=>?@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_@ABCDEFGHIJKLMNOPQRSTUVWXYZ[\\]^_"
+# console output by Apple 1 character code; CR and the line wraps
+# ConsoleFrontEnd.display() marks with LF both become LF
+CONSOLE_CHARSET = bytes.maketrans(b'\r' + bytes(range(0x20, 0x80)), b'\n' + SIGNETICS_2513[0x20:])
+CONSOLE_BUFFER_SIZE = 4096 # flush() when the buffer gets this long, else once a frame
+
+# Front ends: the keyboard and display of an Apple1System. attach() and
+# detach() start and end their use with a system, display() is the display
+# callback, flush() writes out display output they hold back, and
+# choose_file() picks the file for an ACI load or save (None to cancel).
+
+class ConsoleFrontEnd:
+    """
+    The terminal: keys from stdin in raw mode, read on a thread, and the
+    display on stdout; without keyboard it only writes the display.
+    """
+    def __init__(self, keyboard=True):
+        self.keyboard = keyboard
+        self.buffer = bytearray() # display output not written yet
+        self.terminal = None # (init_terminal, reset_terminal) from setup_console()
+
+    def attach(self, system):
+        if self.keyboard:
+            self.terminal = setup_console(system)
+
+    def detach(self):
+        if self.terminal:
+            self.terminal[1]()
+
+    def display(self, system, char, raw_display):
+        """Translates Apple 1 character codes to the system console, flush() writes them out."""
+        char = char & 0x7F
+        if char == 0x0D or char > 0x1F:
+            self.buffer.append(char)
+            if system.screen.column == 0 and char != 0x0D and not raw_display:
+                # the screen wrapped the line
+                self.buffer.append(0x0A)
+        if len(self.buffer) >= CONSOLE_BUFFER_SIZE:
+            self.flush()
+
+    def flush(self):
+        """Writes the display output to stdout, with a single os.write() when it can."""
+        if self.buffer:
+            data = self.buffer.translate(CONSOLE_CHARSET)
+            if self.terminal:
+                data = data.replace(b'\n', b'\r\n') # the terminal is in raw mode
+            data = memoryview(data)
+            self.buffer.clear()
+            sys.stdout.flush() # anything written through sys.stdout goes first
+            while data:
+                data = data[os.write(sys.stdout.fileno(), data):]
+
+    def choose_file(self, save):
+        if tkinter_available:
+            ask = filedialog.asksaveasfilename if save else filedialog.askopenfilename
+            return ask(filetypes=[("Binary file", "*.bin"), ("All files", "*.*")])
+        if self.terminal:
+            self.terminal[1]()
+        try:
+            return input(f"Input a binary file to {'save' if save else 'load'}: ")
+        finally:
+            if self.terminal:
+                self.terminal[0]()
+
+class MemoryFrontEnd:
+    """
+    In-memory endpoints for a headless or embedded system: send() types keys
+    ahead and the display output collects in output.
+    """
+    def __init__(self):
+        self.output = bytearray()
+        self.files = deque()
+        self.system = None
+
+    def attach(self, system):
+        self.system = system
+
+    def detach(self):
+        self.system = None
+
+    def send(self, text):
+        self.system.paste(text)
+
+    def read(self):
+        """Returns the display output so far and clears it."""
+        data = bytes(self.output)
+        self.output.clear()
+        return data
+
+    def display(self, system, char, raw_display):
+        self.output.append(char & 0x7F)
+
+    def flush(self):
+        pass
+
+    def choose_file(self, save):
+        return self.files.popleft() if self.files else None
 
 def null_display(self, char, raw_display):
     """A null display."""
     pass
 
+def key_codes(text):
+    """
+    Apple 1 keyboard codes for text typed ahead, as key_pressed() maps keys;
+    characters the keyboard doesn't have are left out.
+    """
+    codes = bytearray()
+    for char in text.replace(b'\r\n', b'\r').replace(b'\n', b'\r').upper():
+        if 31 < char < 96 or char == 13 or char == 27:
+            codes.append(char | 0x80)
+        elif char == 8 or char == 127:
+            codes.append(0x5F | 0x80)
+    return bytes(codes)
+
+class RecordedNetwork:
+    """
+    Stands in for a requests Session with responses kept in a directory, a
+    file per URL: records them with a session, replays them without one.
+    """
+    def __init__(self, directory, session=None):
+        self.directory = directory
+        self.session = session
+
+    def path(self, url):
+        return os.path.join(self.directory, quote(url, safe='') or '%')
+
+    def get(self, url, stream=False):
+        if self.session is not None:
+            self.content = self.session.get(url).content
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path(url), 'wb') as f:
+                f.write(self.content)
+        elif exists(self.path(url)):
+            with open(self.path(url), 'rb') as f:
+                self.content = f.read()
+        else:
+            self.content = b''
+        return self
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+class Pacer:
+    """
+    Keeps emulated time in step with the host's monotonic clock, sleeping
+    once per slice of about a millisecond for however far ahead it is.
+    """
+    SLICE = 0.001 # seconds of emulated time per slice
+    IDLE_SLICE = 1 / 60.05 # per slice while the CPU polls the keyboard or display
+    MAX_DRIFT = 0.1 # seconds behind (or ahead) after which pacing starts over
+
+    def __init__(self, mhz, cycles=0):
+        self.hz = mhz * 1e6
+        self.slice_cycles = max(1, int(self.hz * self.SLICE))
+        self.idle_slice_cycles = max(1, int(self.hz * self.IDLE_SLICE))
+        self.resync(cycles)
+
+    def resync(self, cycles):
+        self.start, self.start_cycles = monotonic(), cycles
+
+    def pace(self, cycles):
+        ahead = (cycles - self.start_cycles) / self.hz - (monotonic() - self.start)
+        if abs(ahead) > self.MAX_DRIFT:
+            # a reset, a slow host or a suspended process: don't try to catch up
+            self.resync(cycles)
+        elif ahead > 0:
+            sleep(ahead)
+
+class Profiler:
+    """
+    Sampling profiler for emulated code, attached with MPU6502.profile(): a
+    sample about every interval cycles, or every timer seconds of host time.
+    """
+    def __init__(self, interval=101, timer=None, seed=None):
+        self.interval = interval
+        self.timer = timer
+        self.random = random if seed is None else Random(seed).random # jitter
+        self.addresses = {} # pc -> [samples, sum of 1 / instruction cycles]
+        self.opcodes = {} # opcode -> [samples, sum of 1 / instruction cycles]
+        self.samples = 0
+        self.cycles = 0 # cycles profiled
+        self.start_cycles = None
+        self.next_sample = float('inf')
+
+    def start(self, cycles):
+        self.start_cycles = cycles
+        if self.timer:
+            threading.Thread(target=self.tick, daemon=True).start()
+        else:
+            self.next_sample = cycles + int(self.interval * 2 * self.random())
+
+    def stop(self, cycles):
+        if self.start_cycles is not None:
+            self.cycles += cycles - self.start_cycles
+            self.start_cycles = None
+        self.next_sample = float('inf')
+
+    def rebase(self, old, new):
+        # the cycle count jumped from old to new: a reset or a restored state
+        if self.start_cycles is not None:
+            self.cycles += old - self.start_cycles
+            self.start_cycles = new
+            if not self.timer:
+                self.next_sample += new - old
+
+    def tick(self):
+        while self.start_cycles is not None:
+            sleep(self.timer)
+            self.next_sample = 0
+
+    def sample(self, pc, opcode, start, end):
+        weight = 1 / max(1, end - start)
+        for counts, key in ((self.addresses, pc), (self.opcodes, opcode)):
+            entry = counts.get(key)
+            if entry is None:
+                counts[key] = [1, weight]
+            else:
+                entry[0] += 1
+                entry[1] += weight
+        self.samples += 1
+        if self.timer:
+            self.next_sample = float('inf')
+        else:
+            self.next_sample = end + int(self.interval * 2 * self.random())
+
+    def report(self, cpu, file):
+        """Writes the report: per address and per opcode, hottest first."""
+        if cpu.profiler is self:
+            cpu.profile(None)
+        per_sample = self.cycles / self.samples if self.samples else 0
+        file.write(f'{self.cycles} cycles profiled, {self.samples} samples, one per {per_sample:.1f} cycles\n')
+        def rows(counts, label):
+            for key, (samples, weight) in sorted(counts.items(), key=lambda item: -item[1][0]):
+                yield (f'{label(key):<20} {samples:>9} {samples / self.samples:>7.2%} '
+                       f'{round(samples * per_sample):>13} {round(weight * per_sample):>11}\n')
+        def address(pc):
+            code = [cpu.ram[(pc + i) & 0xFFFF] for i in range(InstructionCompiler.LENGTHS[cpu.disassemble[cpu.ram[pc]][1]])]
+            return f'${pc:04x}  {disassemble_instruction(cpu.disassemble, pc, code)}'
+        def opcode(op):
+            name, mode = cpu.disassemble[op]
+            return f'${op:02x}  {name} {mode}'
+        header = f"{'':<20} {'samples':>9} {'%':>7} {'est. cycles':>13} {'est. runs':>11}\n"
+        file.write('\nAddresses\n' + header)
+        file.writelines(rows(self.addresses, address))
+        file.write('\nOpcodes\n' + header)
+        file.writelines(rows(self.opcodes, opcode))
+
+class Tracer:
+    """
+    Instruction trace in a ring buffer, attached with MPU6502.trace(). dump()
+    writes the records oldest first, decode_trace() prints them.
+    """
+    MAGIC = b'A1TR'
+    VERSION = 1
+    HEADER = struct.Struct('<4sB6sI') # magic, version, MPU name, record count
+    RECORD = struct.Struct('<QHBBBBBBBB') # cycles, pc, opcode, 2 bytes after it, a, x, y, sp, p
+
+    def __init__(self, records=1 << 20):
+        self.buffer = bytearray(records * self.RECORD.size)
+        self.offset = 0 # of the next record
+        self.wrapped = False
+        self.name = '6502'
+
+    def records(self):
+        # oldest first, without copying the buffer
+        view = memoryview(self.buffer)
+        return (view[self.offset:], view[:self.offset]) if self.wrapped else (view[:self.offset],)
+
+    def dump(self, file_path):
+        parts = self.records()
+        count = sum(len(part) for part in parts) // self.RECORD.size
+        with open(file_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.name.encode(), count))
+            for part in parts:
+                f.write(part)
+
+def decode_trace(file_path, out=sys.stdout, last=None):
+    """Prints a trace written by Tracer.dump(), or its last records."""
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    if len(data) < Tracer.HEADER.size:
+        raise ValueError(f'{file_path} is not an instruction trace')
+    magic, version, name, count = Tracer.HEADER.unpack_from(data)
+    if magic != Tracer.MAGIC or version != Tracer.VERSION or len(data) != Tracer.HEADER.size + count * Tracer.RECORD.size:
+        raise ValueError(f'{file_path} is not an instruction trace')
+    disassemble = (MPU65C02 if name.rstrip(b'\0') == b'65C02' else MPU6502).disassemble
+    first = 0 if last is None else max(0, count - last)
+    records = memoryview(data)[Tracer.HEADER.size + first * Tracer.RECORD.size:]
+    out.write(f"{'cycles':>12}  pc    {'bytes':<8}  {'instruction':<14}  a  x  y  sp NV-BDIZC\n")
+    for cycles, pc, *code, a, x, y, sp, p in Tracer.RECORD.iter_unpack(records):
+        code = code[:InstructionCompiler.LENGTHS[disassemble[code[0]][1]]]
+        out.write(f"{cycles:>12}  {pc:04x}  {' '.join(f'{byte:02x}' for byte in code):<8}  "
+                  f"{disassemble_instruction(disassemble, pc, code):<14}  {a:02x} {x:02x} {y:02x} {sp:02x} {p:08b}\n")
+
+def clock_speed(value):
+    """Parses --mhz: a clock speed in MHz, or 'unlimited'."""
+    if value.lower() in ('unlimited', 'max'):
+        return None
+    try:
+        mhz = float(value)
+    except ValueError:
+        mhz = 0
+    if not mhz > 0:
+        raise argparse.ArgumentTypeError(f"expected a clock speed in MHz or 'unlimited', got {value!r}")
+    return mhz
+
+def rom_image(spec):
+    """Parses a --rom FILE@ADDR argument into an (address, data) image."""
+    file_path, _, addr = spec.rpartition('@')
+    try:
+        addr = int(addr, 16)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'expected FILE@ADDR with a hex address, got {spec!r}')
+    if not file_path or not 0 <= addr <= 0xFFFF:
+        raise argparse.ArgumentTypeError(f'expected FILE@ADDR with a hex address, got {spec!r}')
+    try:
+        with open(file_path, 'rb') as f:
+            return addr, f.read()
+    except OSError as e:
+        raise argparse.ArgumentTypeError(f"can't read ROM image: {e}")
+
+def hex_address(value):
+    try:
+        addr = int(value, 16)
+    except ValueError:
+        addr = -1
+    if not 0 <= addr <= 0xFFFF:
+        raise argparse.ArgumentTypeError(f'expected a hex address, got {value!r}')
+    return addr
+
+def watch_range(spec):
+    """Parses a --watch START[-END][:ACCESS] argument into (start, end, access)."""
+    addrs, _, access = spec.partition(':')
+    start, _, end = addrs.partition('-')
+    access = access.lower() or 'rw'
+    if set(access) - set('rw'):
+        raise argparse.ArgumentTypeError(f"expected START[-END][:r|w|rw], got {spec!r}")
+    start = hex_address(start)
+    end = hex_address(end) if end else start
+    if end < start:
+        raise argparse.ArgumentTypeError(f'watch range ends before it starts: {spec!r}')
+    return start, end, access
+
+def rom_file(file_path):
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except OSError as e:
+        raise argparse.ArgumentTypeError(f"can't read ROM image: {e}")
+
+def text_file(file_path):
+    """Parses --type: the contents of a text file."""
+    try:
+        with open(file_path, 'rb') as f:
+            return f.read()
+    except OSError as e:
+        raise argparse.ArgumentTypeError(f"can't read keyboard input: {e}")
+
+def script_file(file_path):
+    """Parses --script: the commands of an expect script."""
+    try:
+        with open(file_path) as f:
+            return parse_script(f.read())
+    except (OSError, ValueError) as e:
+        raise argparse.ArgumentTypeError(f"can't read script: {e}")
+
+# --- Automation ---
+
+class ExpectFailed(Exception):
+    """
+    Raised by Expect.expect() when the output can't match: reason is
+    'timeout', 'input' or the stop reason run() returned.
+    """
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+class Expect:
+    """
+    Drives an Apple1System like someone at the keyboard: send() types keys
+    ahead, expect() runs until the output matches. Timeouts are in cycles.
+    """
+    def __init__(self, system, timeout=100_000_000, slice_cycles=10000):
+        self.system = system
+        self.timeout = timeout # cycles expect() waits by default
+        self.slice_cycles = slice_cycles
+        self.output = bytearray()
+        self.position = 0 # output up to here was matched already
+        self.before = '' # output between the last two matches
+        self.match = None
+        self.display_callback = system.display_callback
+        system.display_callback = self.display
+
+    def display(self, system, char, raw_display):
+        code = char & 0x7F
+        if code == 0x0D or code > 0x1F:
+            self.output.append(CONSOLE_CHARSET[code])
+        self.display_callback(system, char, raw_display)
+
+    def send(self, text):
+        """Types text ahead (see Apple1System.paste())."""
+        self.system.paste(text)
+
+    def sendline(self, text=''):
+        self.send(text + (b'\r' if isinstance(text, bytes) else '\r'))
+
+    def expect(self, pattern, timeout=None):
+        """
+        Runs until the output after the last match matches pattern (strings or
+        regexes) and returns the re.Match; ExpectFailed if it can't.
+        """
+        patterns = pattern if isinstance(pattern, (list, tuple)) else [pattern]
+        patterns = [re.compile(re.escape(p)) if isinstance(p, str) else p for p in patterns]
+        system, cpu = self.system, self.system.cpu
+        timeout = self.timeout if timeout is None else timeout
+        end = cpu.processorCycles + timeout
+        searched, waiting = None, False
+        while True:
+            if len(self.output) != searched:
+                searched = len(self.output)
+                text = self.output[self.position:].decode('latin-1')
+                matches = [m for m in (p.search(text) for p in patterns) if m]
+                if matches:
+                    self.match = min(matches, key=lambda m: m.start())
+                    self.before = text[:self.match.start()]
+                    self.position += self.match.end()
+                    return self.match
+            if waiting:
+                raise ExpectFailed(f'no match for {pattern!r}, the CPU is waiting for input', 'input')
+            if cpu.processorCycles >= end:
+                raise ExpectFailed(f'no match for {pattern!r} in {timeout} cycles', 'timeout')
+            reason = system.run(min(self.slice_cycles, end - cpu.processorCycles))
+            if reason not in (None, 'idle'):
+                raise ExpectFailed(f'no match for {pattern!r}, run() stopped: {reason}', reason)
+            waiting = system.waiting_for_input(reason)
+
+    def wait(self, cycles):
+        """Runs for cycles cycles. Returns None, or the reason run() stopped early."""
+        return self.system.run_until(max_cycles=cycles, slice_cycles=self.slice_cycles)
+
+# send TEXT, sendline TEXT (and return), expect TEXT or /REGEX/, wait CYCLES,
+# timeout CYCLES (for later expects); TEXT may be in "quotes", with \ escapes
+SCRIPT_COMMANDS = ('send', 'sendline', 'expect', 'wait', 'timeout')
+
+def parse_script(text):
+    """Parses an expect script into (line number, command, argument) tuples."""
+    commands = []
+    for number, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        command, _, argument = line.partition(' ')
+        argument = argument.strip()
+        if command not in SCRIPT_COMMANDS:
+            raise ValueError(f'line {number}: unknown command {command!r}')
+        if command in ('wait', 'timeout'):
+            try:
+                argument = int(argument)
+            except ValueError:
+                raise ValueError(f'line {number}: {command} needs a number of cycles') from None
+        elif command == 'expect' and len(argument) > 1 and argument[0] == argument[-1] == '/':
+            try:
+                argument = re.compile(argument[1:-1])
+            except re.error as e:
+                raise ValueError(f'line {number}: {e}') from None
+        else:
+            if len(argument) > 1 and argument[0] == argument[-1] == '"':
+                argument = argument[1:-1]
+            argument = argument.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+            if command == 'expect' and not argument:
+                raise ValueError(f'line {number}: expect needs some text')
+        commands.append((number, command, argument))
+    return commands
+
+def run_script(expect, commands):
+    """Runs parse_script() commands with an Expect. Raises ExpectFailed with the line number when an expect fails."""
+    for number, command, argument in commands:
+        if command == 'timeout':
+            expect.timeout = argument
+        elif command == 'wait':
+            expect.wait(argument)
+        elif command == 'expect':
+            try:
+                expect.expect(argument)
+            except ExpectFailed as e:
+                raise ExpectFailed(f'line {number}: {e}', e.reason) from None
+        else:
+            getattr(expect, command)(argument)
+
+# --- Session Server ---
+
+TELNET_IAC = 255
+TELNET_SB, TELNET_SE = 250, 240
+TELNET_WILL, TELNET_DO = 251, 253
+TELNET_ECHO, TELNET_SGA = 1, 3
+# character at a time, the server echoes (the Apple-1 does)
+TELNET_CHARACTER_MODE = bytes([TELNET_IAC, TELNET_WILL, TELNET_ECHO, TELNET_IAC, TELNET_WILL, TELNET_SGA, TELNET_IAC, TELNET_DO, TELNET_SGA])
+
+class SocketFrontEnd(ConsoleFrontEnd):
+    """
+    The front end of a server session: keys from a TCP client (telnet or a
+    raw socket) and the display written back to it as text.
+    """
+    def __init__(self, writer):
+        super().__init__(keyboard=False)
+        self.writer = writer
+        self.system = None
+        self.telnet = b'' # an incomplete telnet command from the last receive()
+        self.cr = False # the last key was CR, a LF after it is part of the line end
+
+    def attach(self, system):
+        self.system = system
+
+    def detach(self):
+        self.system = None
+        self.writer.close()
+
+    def flush(self):
+        if self.buffer:
+            self.writer.write(self.buffer.translate(CONSOLE_CHARSET).replace(b'\n', b'\r\n'))
+            self.buffer.clear()
+
+    def choose_file(self, save):
+        return None
+
+    def receive(self, data):
+        """Types the keys in data from the client, without its telnet commands."""
+        data, self.telnet = telnet_text(self.telnet + data)
+        if self.cr and data[:1] in (b'\n', b'\0'):
+            data = data[1:]
+        if data:
+            self.cr = data[-1:] == b'\r'
+        if b'\t' in data:
+            self.system.post(self.system.reset_button)
+        self.system.paste(data.replace(b'\r\0', b'\r'))
+
+def telnet_text(data):
+    """Splits the telnet commands out of data. Returns (text, the start of an incomplete command at the end)."""
+    text = bytearray()
+    i = 0
+    while i < len(data):
+        start = data.find(TELNET_IAC, i)
+        if start < 0:
+            text += data[i:]
+            break
+        text += data[i:start]
+        if start + 1 >= len(data):
+            return bytes(text), data[start:]
+        command = data[start + 1]
+        if command == TELNET_IAC:
+            i = start + 2 # an escaped 255, no key for it
+        elif command == TELNET_SB:
+            end = data.find(bytes([TELNET_IAC, TELNET_SE]), start + 2)
+            if end < 0:
+                return bytes(text), data[start:]
+            i = end + 2
+        elif TELNET_WILL <= command <= 254:
+            if start + 2 >= len(data):
+                return bytes(text), data[start:]
+            i = start + 3
+        else:
+            i = start + 2
+    return bytes(text), b''
+
+class SessionServer:
+    """
+    Serves Apple-1 machines over TCP, one per connection, on one asyncio event
+    loop, or on the worker processes of a SessionPool.
+    """
+    TICK = 1 / 60 # seconds
+    WRITE_LIMIT = 1 << 16 # bytes a client can fall behind before its machine waits for it
+
+    def __init__(self, make_system, slice_cycles=17050, max_sessions=64, pool=None):
+        self.make_system = make_system # frontend -> a new Apple1System
+        self.slice_cycles = slice_cycles
+        self.max_sessions = max_sessions
+        self.pool = pool
+        self.sessions = set() # SocketFrontEnds, or pool session numbers
+        self.running = set() # the ones whose machines get slices
+        self.wake = asyncio.Event() # set when a machine starts running
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.connect, host, port)
+        async with server:
+            if self.pool:
+                self.pool.deliver = asyncio.get_running_loop().call_soon_threadsafe
+                await server.serve_forever()
+            else:
+                await self.schedule()
+
+    async def connect(self, reader, writer):
+        if len(self.sessions) >= self.max_sessions:
+            writer.write(b'Too many sessions, try again later\r\n')
+            writer.close()
+            return
+        if self.pool:
+            await self.connect_pooled(reader, writer)
+            return
+        session = SocketFrontEnd(writer)
+        system = self.make_system(session)
+        system.reset()
+        writer.write(TELNET_CHARACTER_MODE)
+        self.sessions.add(session)
+        self.start(session)
+        try:
+            while data := await reader.read(4096):
+                session.receive(data)
+                self.start(session)
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions.discard(session)
+            self.running.discard(session)
+            system.close()
+
+    async def connect_pooled(self, reader, writer):
+        paused = False
+        async def drain(number):
+            nonlocal paused
+            try:
+                await writer.drain()
+            except ConnectionError:
+                return
+            paused = False
+            self.pool.resume(number)
+        def listen(kind, data):
+            nonlocal paused
+            if kind == 'output':
+                writer.write(data)
+                if not paused and writer.transport.get_write_buffer_size() > self.WRITE_LIMIT:
+                    paused = True
+                    self.pool.pause(number)
+                    asyncio.ensure_future(drain(number))
+            elif kind == 'closed':
+                sys.stderr.write(f'Session closed, {data.decode()}\n')
+                writer.close()
+        writer.write(TELNET_CHARACTER_MODE)
+        number = self.pool.open(listen)
+        self.sessions.add(number)
+        try:
+            while data := await reader.read(4096):
+                self.pool.send(number, data)
+        except ConnectionError:
+            pass
+        finally:
+            self.sessions.discard(number)
+            self.pool.kill(number)
+            writer.close()
+
+    def start(self, session):
+        self.running.add(session)
+        self.wake.set()
+
+    async def schedule(self):
+        loop = asyncio.get_running_loop()
+        tick = loop.time()
+        while True:
+            if not self.running:
+                self.wake.clear()
+                await self.wake.wait()
+                tick = loop.time()
+            for session in list(self.running):
+                if session.writer.transport.get_write_buffer_size() > self.WRITE_LIMIT:
+                    continue
+                system = session.system
+                try:
+                    reason = system.run(self.slice_cycles)
+                except Exception as e:
+                    # one broken machine doesn't take the others down
+                    sys.stderr.write(f'Session closed, {type(e).__name__}: {e}\n')
+                    self.running.discard(session)
+                    session.writer.close()
+                    continue
+                session.flush()
+                if system.waiting_for_input(reason):
+                    self.running.discard(session)
+            # a tick that ran late makes the next one shorter, but the
+            # machines never get more than one slice a tick
+            tick = max(tick + self.TICK, loop.time())
+            await asyncio.sleep(tick - loop.time())
+
+# --- Session Pool ---
+
+# A SessionPool and its workers talk in messages of a kind byte and a
+# session number, then the payload: the keys, display output or state
+POOL_HEADER = struct.Struct('<BI')
+POOL_COUNT = struct.Struct('<I')
+# to a worker
+POOL_OPEN, POOL_KEYS, POOL_RESET, POOL_SNAPSHOT, POOL_KILL, POOL_MOVE, POOL_PAUSE, POOL_RESUME, POOL_STOP = range(9)
+# from a worker
+POOL_OUTPUT, POOL_IDLE, POOL_STATE, POOL_CLOSED, POOL_MOVED = range(16, 21)
+
+class PoolWriter:
+    """The writer of a worker machine's SocketFrontEnd: display output goes back to the pool."""
+    def __init__(self, send, number):
+        self.send = send
+        self.number = number
+
+    def write(self, data):
+        self.send(POOL_OUTPUT, self.number, data)
+
+    def close(self):
+        pass
+
+def pool_worker(conn, options, slice_cycles):
+    """
+    A SessionPool worker process: runs the machines the pool opens on it, a
+    slice a tick, and reports the ones waiting for a key as idle.
+    """
+    systems = {} # session number -> Apple1System
+    wakes = {} # session number -> OPEN, KEYS and RESET messages so far
+    running = set()
+    paused = set() # their clients are behind on the display output
+
+    def send(kind, number, payload=b''):
+        conn.send_bytes(POOL_HEADER.pack(kind, number) + payload)
+
+    def close(number):
+        systems.pop(number).close()
+        del wakes[number]
+        running.discard(number)
+        paused.discard(number)
+
+    def handle(message):
+        kind, number = POOL_HEADER.unpack_from(message)
+        payload = message[POOL_HEADER.size:]
+        if kind == POOL_STOP:
+            return False
+        if kind == POOL_OPEN:
+            try:
+                system = Apple1System(frontend=SocketFrontEnd(PoolWriter(send, number)), **options)
+                if payload:
+                    system.restore(payload)
+                    system.frontend.buffer.clear() # the client has the screen already
+                else:
+                    system.reset()
+            except Exception as e:
+                send(POOL_CLOSED, number, f'{type(e).__name__}: {e}'.encode())
+                return True
+            systems[number] = system
+            wakes[number] = 0
+        system = systems.get(number)
+        if system is None:
+            return True # killed, or moved
+        if kind == POOL_KEYS:
+            system.frontend.receive(payload)
+        elif kind == POOL_RESET:
+            system.reset_button()
+        elif kind == POOL_SNAPSHOT:
+            send(POOL_STATE, number, system.snapshot(delta=payload == b'\x01'))
+        elif kind == POOL_MOVE:
+            send(POOL_MOVED, number, system.snapshot(checkpoint=False))
+        elif kind == POOL_PAUSE:
+            paused.add(number)
+        elif kind == POOL_RESUME:
+            paused.discard(number)
+        if kind in (POOL_KILL, POOL_MOVE):
+            close(number)
+        elif kind in (POOL_OPEN, POOL_KEYS, POOL_RESET):
+            wakes[number] += 1
+            running.add(number)
+        return True
+
+    # with fork, the other workers hold this pipe open too: watch for the pool's process ending
+    watched = [conn, multiprocessing.parent_process().sentinel]
+    tick = monotonic()
+    try:
+        while True:
+            # every message waiting is handled before each round of slices,
+            # even when the slices take longer than a tick
+            active = running - paused
+            ready = multiprocessing.connection.wait(watched, max(0, tick - monotonic()) if active else None)
+            if ready:
+                if conn not in ready:
+                    break
+                while conn.poll():
+                    if not handle(conn.recv_bytes()):
+                        return
+            now = monotonic()
+            active = running - paused
+            if active and now >= tick:
+                tick = max(tick + SessionServer.TICK, now)
+                for number in active:
+                    system = systems[number]
+                    try:
+                        reason = system.run(slice_cycles)
+                    except Exception as e:
+                        send(POOL_CLOSED, number, f'{type(e).__name__}: {e}'.encode())
+                        close(number)
+                        continue
+                    system.frontend.flush()
+                    if system.waiting_for_input(reason):
+                        running.discard(number)
+                        send(POOL_IDLE, number, POOL_COUNT.pack(wakes[number]))
+    except (EOFError, OSError, KeyboardInterrupt):
+        pass # the pool is gone, or the server is being stopped
+
+class PoolWorker:
+    """A worker process of a SessionPool, and the load on it."""
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        self.started = monotonic()
+        self.sessions = set() # PoolSessions placed on it
+        self.running = 0 # how many of them aren't idle
+
+class PoolSession:
+    def __init__(self, number, worker, listener):
+        self.number = number
+        self.worker = worker
+        self.listener = listener # (kind, data), see SessionPool
+        self.wakes = 0 # OPEN, KEYS and RESET messages sent to its worker
+        self.idle = False
+        self.held = None # messages held back while it moves to another worker
+
+class SessionPool:
+    """
+    Runs machines on worker processes, by default one per core. Listeners get
+    their calls through deliver(func, *args), by default from poll().
+    """
+    MOVE_LOAD = 2 # running machines a worker has over the quietest before a waking one moves
+    RESPAWN_AFTER = 1 # seconds a worker has to have run to be replaced when it exits
+
+    def __init__(self, options, slice_cycles=17050, workers=None):
+        """options are the Apple1System arguments (mpu, engine, roms, ...) for every machine."""
+        self.options = options
+        self.slice_cycles = slice_cycles
+        self.calls = queue.SimpleQueue()
+        self.deliver = lambda *call: self.calls.put(call)
+        self.sessions = {} # session number -> PoolSession
+        self.numbers = itertools.count(1)
+        self.closing = False
+        self.workers = []
+        for _ in range(workers or os.cpu_count() or 1):
+            self.start_worker()
+
+    def start_worker(self):
+        conn, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=pool_worker, args=(child, self.options, self.slice_cycles), daemon=True)
+        process.start()
+        child.close()
+        worker = PoolWorker(process, conn)
+        self.workers.append(worker)
+        threading.Thread(target=self.read, args=(worker,), daemon=True).start()
+
+    def read(self, worker):
+        # a reader thread
+        try:
+            try:
+                while True:
+                    message = worker.conn.recv_bytes()
+                    self.deliver(self.receive, worker, message)
+            except (EOFError, OSError):
+                self.deliver(self.lost, worker)
+        except RuntimeError:
+            pass # deliver's event loop is closed, the server is done
+
+    def post(self, worker, kind, number, payload=b''):
+        worker.conn.send_bytes(POOL_HEADER.pack(kind, number) + payload)
+
+    def quietest(self):
+        return min(self.workers, key=lambda worker: (worker.running, len(worker.sessions)))
+
+    def open(self, listener, state=None):
+        """Starts a machine, from a snapshot() state or reset. Returns its session number."""
+        if not self.workers:
+            raise RuntimeError('the pool has no worker processes left')
+        session = PoolSession(next(self.numbers), self.quietest(), listener)
+        self.sessions[session.number] = session
+        session.worker.sessions.add(session)
+        session.worker.running += 1
+        session.wakes = 1
+        self.post(session.worker, POOL_OPEN, session.number, state or b'')
+        return session.number
+
+    def send(self, number, data):
+        """Types data, as a telnet client's keys (see SocketFrontEnd.receive())."""
+        self.wake(self.sessions[number], POOL_KEYS, data)
+
+    def reset(self, number):
+        self.wake(self.sessions[number], POOL_RESET)
+
+    def snapshot(self, number, delta=False):
+        """Asks for the machine's save state, or a delta on its last one, which comes to the listener."""
+        self.control(self.sessions[number], POOL_SNAPSHOT, b'\x01' if delta else b'')
+
+    def pause(self, number):
+        """Stops the machine running until resume(): its client is behind on the display output."""
+        self.control(self.sessions[number], POOL_PAUSE)
+
+    def resume(self, number):
+        if number in self.sessions:
+            self.control(self.sessions[number], POOL_RESUME)
+
+    def kill(self, number):
+        session = self.sessions.pop(number, None)
+        if session:
+            self.control(session, POOL_KILL)
+            self.drop(session)
+
+    def control(self, session, kind, payload=b''):
+        if session.held is not None:
+            session.held.append((kind, payload))
+        else:
+            self.post(session.worker, kind, session.number, payload)
+
+    def drop(self, session):
+        session.worker.sessions.discard(session)
+        if not session.idle:
+            session.worker.running -= 1
+
+    def wake(self, session, kind, payload=b''):
+        if session.held is not None:
+            session.held.append((kind, payload))
+            return
+        if session.idle:
+            session.idle = False
+            quietest = self.quietest()
+            if session.worker.running >= quietest.running + self.MOVE_LOAD:
+                # move it there, then send this on
+                self.post(session.worker, POOL_MOVE, session.number)
+                session.worker.sessions.discard(session)
+                session.worker = quietest
+                quietest.sessions.add(session)
+                session.held = [(kind, payload)]
+                quietest.running += 1
+                return
+            session.worker.running += 1
+        session.wakes += 1
+        self.post(session.worker, kind, session.number, payload)
+
+    def receive(self, worker, message):
+        """Handles a message from a worker."""
+        kind, number = POOL_HEADER.unpack_from(message)
+        session = self.sessions.get(number)
+        if session is None:
+            return # killed
+        payload = message[POOL_HEADER.size:]
+        if kind == POOL_OUTPUT:
+            session.listener('output', payload)
+        elif kind == POOL_IDLE:
+            # stale if it was woken again, or moved, since
+            if worker is session.worker and POOL_COUNT.unpack(payload)[0] == session.wakes and not session.idle:
+                session.idle = True
+                worker.running -= 1
+                session.listener('idle', b'')
+        elif kind == POOL_STATE:
+            session.listener('state', payload)
+        elif kind == POOL_MOVED:
+            # start it on its new worker
+            held, session.held = session.held, None
+            self.post(session.worker, POOL_OPEN, number, payload)
+            session.wakes = 1
+            for kind, payload in held:
+                if kind in (POOL_KEYS, POOL_RESET):
+                    session.wakes += 1
+                self.post(session.worker, kind, number, payload)
+        elif kind == POOL_CLOSED:
+            del self.sessions[number]
+            self.drop(session)
+            session.listener('closed', payload)
+
+    def lost(self, worker):
+        for session in list(worker.sessions):
+            if self.sessions.pop(session.number, None):
+                session.listener('closed', b'the worker process exited')
+        worker.sessions.clear()
+        worker.running = 0
+        self.workers.remove(worker)
+        # a worker that ran for a while crashed, one that didn't would again
+        if not self.closing and monotonic() - worker.started >= self.RESPAWN_AFTER:
+            self.start_worker()
+
+    def poll(self, timeout=None):
+        """
+        Handles the workers' messages, with the default deliver, waiting up to
+        timeout seconds for the first. Returns False if none came.
+        """
+        try:
+            call = self.calls.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        while True:
+            call[0](*call[1:])
+            try:
+                call = self.calls.get_nowait()
+            except queue.Empty:
+                return True
+
+    def run_jobs(self, inputs, timeout=None):
+        """
+        Types each of inputs (bytes) into a machine of its own and returns their
+        display output once all are waiting for a key, or after timeout seconds.
+        """
+        outputs = [bytearray() for _ in inputs]
+        waiting = {}
+        def listener(i):
+            def listen(kind, data):
+                if kind == 'output':
+                    outputs[i] += data
+                elif kind in ('idle', 'closed'):
+                    waiting.pop(i, None)
+            return listen
+        numbers = []
+        for i, text in enumerate(inputs):
+            waiting[i] = self.open(listener(i))
+            numbers.append(waiting[i])
+            self.send(waiting[i], text)
+        end = None if timeout is None else monotonic() + timeout
+        try:
+            while waiting and self.workers:
+                left = None if end is None else end - monotonic()
+                if left is not None and left <= 0:
+                    break
+                self.poll(left)
+        finally:
+            for number in numbers:
+                self.kill(number)
+        return [bytes(output) for output in outputs]
+
+    def close(self):
+        """Stops the workers."""
+        self.closing = True
+        for worker in self.workers:
+            try:
+                self.post(worker, POOL_STOP, 0)
+            except OSError:
+                pass
+        for worker in self.workers:
+            worker.process.join(1)
+            if worker.process.is_alive():
+                worker.process.terminate()
+
+def serve(args):
+    """The serve command: runs a SessionServer until interrupted."""
+    mpu = MPU65C02 if getattr(args, '65c02') else MPU6502
+    options = dict(mpu=mpu, no_aci=args.no_aci, engine=args.engine, roms=args.rom, mhz=args.mhz)
+    def make_system(frontend):
+        return Apple1System(frontend=frontend, **options)
+    slice_cycles = args.slice or round(args.mhz * 1e6 * SessionServer.TICK)
+    pool = SessionPool(options, slice_cycles, args.workers) if args.workers else None
+    server = SessionServer(make_system, slice_cycles, args.max_sessions, pool)
+    sys.stderr.write(f'Serving Apple-1 sessions on {args.host} port {args.port}' + (f', {len(pool.workers)} worker processes\n' if pool else '\n'))
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        sys.stderr.write(f'{e}\n')
+        return 1
+    finally:
+        if pool:
+            pool.close()
+
+# --- Benchmarks ---
+
+BENCH_DONE = 0xBF00 # workloads finish by storing here, which stops run() with 'done'
+BENCH_SLICE = 10000 # cycles per run() slice
+BENCH_MAX_CYCLES = 200_000_000 # a workload that takes longer than this is broken
+
+# Workload programs, loaded at $0300
+
+# 65536 passes of a mix of binary ALU and shift instructions on zero page
+ALU_PROGRAM = bytes.fromhex(
+    'a2 00'     # $0300  LDX #$00
+    'a0 00'     # $0302  LDY #$00
+    '8a'        # $0304  TXA
+    '65 10'     # $0305  ADC $10
+    '85 10'     # $0307  STA $10
+    '45 11'     # $0309  EOR $11
+    '2a'        # $030b  ROL A
+    '85 11'     # $030c  STA $11
+    'e5 12'     # $030e  SBC $12
+    '4a'        # $0310  LSR A
+    '05 13'     # $0311  ORA $13
+    '85 12'     # $0313  STA $12
+    '29 7f'     # $0315  AND #$7f
+    '66 13'     # $0317  ROR $13
+    '06 14'     # $0319  ASL $14
+    'c5 10'     # $031b  CMP $10
+    '26 14'     # $031d  ROL $14
+    'e6 15'     # $031f  INC $15
+    'ca'        # $0321  DEX
+    'd0 e0'     # $0322  BNE $0304
+    '88'        # $0324  DEY
+    'd0 dd'     # $0325  BNE $0304
+    '8d 00 bf'  # $0327  STA $bf00
+    '4c 2a 03'  # $032a  JMP $032a
+)
+
+# 32768 passes of decimal mode ADC and SBC: a BCD counter, a BCD countdown
+# by the counter, and sums of binary values that aren't valid BCD
+DECIMAL_PROGRAM = bytes.fromhex(
+    'f8'        # $0300  SED
+    'a2 00'     # $0301  LDX #$00
+    'a0 80'     # $0303  LDY #$80
+    '18'        # $0305  CLC
+    'a5 20'     # $0306  LDA $20
+    '69 01'     # $0308  ADC #$01
+    '85 20'     # $030a  STA $20
+    'a5 21'     # $030c  LDA $21
+    '69 00'     # $030e  ADC #$00
+    '85 21'     # $0310  STA $21
+    '38'        # $0312  SEC
+    'a5 22'     # $0313  LDA $22
+    'e5 20'     # $0315  SBC $20
+    '85 22'     # $0317  STA $22
+    'a5 23'     # $0319  LDA $23
+    'e5 21'     # $031b  SBC $21
+    '85 23'     # $031d  STA $23
+    '8a'        # $031f  TXA
+    '65 24'     # $0320  ADC $24
+    '85 24'     # $0322  STA $24
+    'ca'        # $0324  DEX
+    'd0 de'     # $0325  BNE $0305
+    '88'        # $0327  DEY
+    'd0 db'     # $0328  BNE $0305
+    'd8'        # $032a  CLD
+    '8d 00 bf'  # $032b  STA $bf00
+    '4c 2e 03'  # $032e  JMP $032e
+)
+
+# 8 copies of $1000-$4fff to $5000-$8fff with LDA ($00),Y / STA ($02),Y
+MEMCPY_PROGRAM = bytes.fromhex(
+    'a9 08'     # $0300  LDA #$08
+    '85 06'     # $0302  STA $06
+    'a9 00'     # $0304  LDA #$00
+    '85 00'     # $0306  STA $00
+    '85 02'     # $0308  STA $02
+    'a9 10'     # $030a  LDA #$10
+    '85 01'     # $030c  STA $01
+    'a9 50'     # $030e  LDA #$50
+    '85 03'     # $0310  STA $03
+    'a2 40'     # $0312  LDX #$40
+    'a0 00'     # $0314  LDY #$00
+    'b1 00'     # $0316  LDA ($00),Y
+    '91 02'     # $0318  STA ($02),Y
+    'c8'        # $031a  INY
+    'd0 f9'     # $031b  BNE $0316
+    'e6 01'     # $031d  INC $01
+    'e6 03'     # $031f  INC $03
+    'ca'        # $0321  DEX
+    'd0 f2'     # $0322  BNE $0316
+    'c6 06'     # $0324  DEC $06
+    'd0 dc'     # $0326  BNE $0304
+    '8d 00 bf'  # $0328  STA $bf00
+    '4c 2b 03'  # $032b  JMP $032b
+)
+
+# Fixed filler data for the copy and the network download
+BENCH_DATA = bytes((i * 7 + (i >> 8) * 13) & 0xFF for i in range(0x7000))
+
+# Response for the NET ROM's binary loader: $7f, load address, length, then
+# the data. The code at the start of it signals the end of the download.
+NET_PAYLOAD = (b'\x7f' + (0x1000).to_bytes(2, 'little') + len(BENCH_DATA).to_bytes(2, 'little')
+               + bytes.fromhex('8d 00 bf 4c 03 10') + BENCH_DATA[6:])
+
+# Branch opcodes -> (flag, value of the flag that takes the branch)
+BRANCH_TAKEN = {0x10: (0x80, 0), 0x30: (0x80, 0x80), 0x50: (0x40, 0), 0x70: (0x40, 0x40),
+                0x90: (0x01, 0), 0xB0: (0x01, 0x01), 0xD0: (0x02, 0), 0xF0: (0x02, 0x02)}
+
+class LocalNetwork:
+    """Stands in for a requests Session: every URL gets the same response."""
+    def __init__(self, content):
+        self.content = content
+        self.urls = []
+
+    def get(self, url, stream=False):
+        self.urls.append(url)
+        return self
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+def bench_system(mpu, engine, keys=b'', program=None, data=(), network=None):
+    """
+    A headless Apple-1 for a workload: keys typed into Wozmon, or a program
+    started at $0300, with data images loaded as (address, bytes).
+    """
+    system = Apple1System(mpu, no_aci=True, network=network is not None, fast_display=True, engine=engine, net_session=network, deterministic=True)
+    system.write_map[BENCH_DONE >> 8] = lambda addr, value: system.cpu.stop('done')
+    system.reset()
+    for addr, image in data:
+        system.memory[addr:addr + len(image)] = image
+    if program is not None:
+        system.memory[0x0300:0x0300 + len(program)] = program
+        system.cpu.pc = 0x0300
+    system.kbd.extend(key | 0x80 for key in keys)
+    return system
+
+def stored_done(system, reason):
+    return reason == 'done'
+
+def trapped(system, reason):
+    """True when the CPU is stuck in a JMP * or a taken branch to itself."""
+    cpu, ram = system.cpu, system.memory
+    opcode, pc = ram[cpu.pc], cpu.pc
+    if opcode == 0x4C:
+        return ram[(pc + 1) & 0xFFFF] | ram[(pc + 2) & 0xFFFF] << 8 == pc
+    if opcode in BRANCH_TAKEN and ram[(pc + 1) & 0xFFFF] == 0xFE:
+        flag, taken = BRANCH_TAKEN[opcode]
+        return cpu.p & flag == taken
+    return False
+
+def wozmon_dump(mpu, engine):
+    return bench_system(mpu, engine, keys=b'0.1FFF\rBF00:0\r'), stored_done
+
+def alu_loop(mpu, engine):
+    return bench_system(mpu, engine, program=ALU_PROGRAM), stored_done
+
+def decimal_loop(mpu, engine):
+    return bench_system(mpu, engine, program=DECIMAL_PROGRAM), stored_done
+
+def memcpy_loop(mpu, engine):
+    return bench_system(mpu, engine, program=MEMCPY_PROGRAM, data=[(0x1000, BENCH_DATA[:0x4000])]), stored_done
+
+def net_download(mpu, engine):
+    return bench_system(mpu, engine, keys=b'C100R\rBENCH\r', network=LocalNetwork(NET_PAYLOAD)), stored_done
+
+def functional_test(image, start=0x0400, success=0x3469):
+    """
+    A workload for a functional test ROM (like Klaus Dormann's 6502 test): a
+    64K image started at start, which ends in a trap at success when it passes.
+    """
+    def setup(mpu, engine):
+        system = bench_system(mpu, engine, data=[(0, image[:0x10000])])
+        # the image covers all 64K: no devices, ROM or done port
+        system.read_map[:] = system.write_map[:] = [None] * 256
+        system.rom_pages[:] = bytes(256)
+        system.cpu.pc = start
+        return system, trapped
+    setup.success = success
+    return setup
+
+BENCHMARKS = {
+    'wozmon-dump': wozmon_dump,
+    'alu': alu_loop,
+    'decimal': decimal_loop,
+    'memcpy': memcpy_loop,
+    'net-download': net_download,
+}
+
+def bench_run(system, finished):
+    """Runs a workload at full speed until finished(system, reason) says it's done."""
+    cpu = system.cpu
+    end = cpu.processorCycles + BENCH_MAX_CYCLES
+    while cpu.processorCycles < end:
+        reason = system.run(BENCH_SLICE)
+        if finished(system, reason):
+            return
+        if reason == 'idle':
+            system.wait_for_event(0.01)
+    raise RuntimeError(f'workload did not finish in {BENCH_MAX_CYCLES} cycles')
+
+def bench_count(system, finished):
+    """Runs a workload one instruction at a time. Returns the number of instructions."""
+    cpu = system.cpu
+    end = cpu.processorCycles + BENCH_MAX_CYCLES
+    count = 0
+    while cpu.processorCycles < end:
+        cpu.step()
+        count += 1
+        reason, cpu.stop_reason = cpu.stop_reason, None
+        if finished(system, reason):
+            return count
+    raise RuntimeError(f'workload did not finish in {BENCH_MAX_CYCLES} cycles')
+
+def bench_state(system):
+    cpu = system.cpu
+    return bytes(system.memory), (cpu.pc, cpu.a, cpu.x, cpu.y, cpu.sp, cpu.p), bytes(system.frontend.output)
+
+def bench_stats(values):
+    return {
+        'mean': statistics.mean(values),
+        'stdev': statistics.stdev(values) if len(values) > 1 else 0.0,
+        'min': min(values),
+        'max': max(values),
+    }
+
+def benchmark(args):
+    """
+    The benchmark subcommand: prints the results as JSON and returns 1 if a
+    run went wrong or was slower than the baseline by more than the threshold.
+    """
+    mpu = MPU65C02 if getattr(args, '65c02') else MPU6502
+    workloads = dict(BENCHMARKS)
+    if args.functional_test:
+        workloads['functional-test'] = functional_test(args.functional_test, success=args.functional_success)
+    names = args.only or list(workloads)
+    for name in names:
+        if name not in workloads:
+            raise SystemExit(f'unknown benchmark: {name} (choose from {", ".join(workloads)})')
+
+    report = {
+        'format': 1,
+        'cpu': mpu.__name__,
+        'engine': args.engine,
+        'python': f'{platform.python_implementation()} {platform.python_version()}',
+        'machine': platform.machine(),
+        'warmup': args.warmup,
+        'repeat': args.repeat,
+        'benchmarks': {},
+    }
+    status = 0
+    for name in names:
+        setup = workloads[name]
+        system, finished = setup(mpu, 'reference')
+        instructions = bench_count(system, finished)
+        expected = bench_state(system)
+        ok = getattr(setup, 'success', system.cpu.pc) == system.cpu.pc
+
+        runs = []
+        for i in range(args.warmup + args.repeat):
+            system, finished = setup(mpu, args.engine)
+            start = perf_counter()
+            bench_run(system, finished)
+            seconds = perf_counter() - start
+            ok = ok and bench_state(system) == expected
+            if i >= args.warmup:
+                runs.append((seconds, system.cpu.processorCycles))
+
+        result = {
+            'ok': ok,
+            'instructions': instructions,
+            'cycles': bench_stats([cycles for seconds, cycles in runs]),
+            'seconds': bench_stats([seconds for seconds, cycles in runs]),
+            'instructions_per_sec': bench_stats([instructions / seconds for seconds, cycles in runs]),
+            'cycles_per_sec': bench_stats([cycles / seconds for seconds, cycles in runs]),
+        }
+        rate = result['cycles_per_sec']
+        result['cv'] = rate['stdev'] / rate['mean'] # relative spread of the runs
+        report['benchmarks'][name] = result
+        if not ok:
+            status = 1
+        print(f"{name}: {rate['mean'] / 1e6:.3f} MHz +-{result['cv']:.1%}, "
+              f"{result['instructions_per_sec']['mean'] / 1e6:.3f} MIPS{'' if ok else ', FAILED'}", file=sys.stderr)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if (baseline.get('cpu'), baseline.get('engine')) != (report['cpu'], report['engine']):
+            print(f"warning: baseline is for {baseline.get('cpu')} on the {baseline.get('engine')} engine", file=sys.stderr)
+        report['baseline'] = args.baseline
+        for name, result in report['benchmarks'].items():
+            if name not in baseline.get('benchmarks', {}):
+                continue
+            before = baseline['benchmarks'][name]['cycles_per_sec']['mean']
+            change = result['cycles_per_sec']['mean'] / before - 1
+            regression = change < -args.threshold / 100
+            result['baseline'] = {'cycles_per_sec': before, 'change': change, 'regression': regression}
+            if regression:
+                status = 1
+            print(f"{name}: {change:+.1%} against the baseline{', REGRESSION' if regression else ''}", file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    return status
+
+# --- Main Program ---
+
+def deterministic_run(system, cycles=None):
+    """
+    The main loop of --deterministic: runs without the host clock until only a
+    key could wake the CPU ('input') or the count gets to cycles ('cycles').
+    """
+    cpu = system.cpu
+    while True:
+        slice_cycles = 1000 if cycles is None else min(1000, cycles - cpu.processorCycles)
+        if slice_cycles <= 0:
+            return 'cycles'
+        reason = system.run(slice_cycles)
+        if isinstance(reason, Break):
+            system.frontend.flush()
+            sys.stderr.write(f'Break: {reason.access} ${reason.address:04x} (${reason.value:02x})\n{cpu!r}\n')
+        if system.waiting_for_input(reason):
+            return 'input'
+
 def apple1_emulator(args):
     """Main program."""
     # Arguments
-    mpu, turbo, bench, raw_display, no_aci, network, fast_display, alt_display, load_state = (MPU65C02 if args.turbo else MPU6502), args.turbo, args.bench, args.raw_display, args.no_aci, args.network, args.fast_display, args.alt_display, args.load_state
+    mpu, turbo, bench, raw_display, no_aci, network, fast_display, alt_display, load_state, engine, roms, mhz = (MPU65C02 if getattr(args, '65c02') else MPU6502), args.turbo, args.bench, args.raw_display, args.no_aci, args.network, args.fast_display, args.alt_display, args.load_state, args.engine, args.rom, args.mhz
+
+    deterministic = args.deterministic
+    net_session = None
+    if network and args.net_replay:
+        net_session = RecordedNetwork(args.net_replay)
+    elif network and args.net_record:
+        net_session = RecordedNetwork(args.net_record, Session())
 
     # System
-    system = Apple1System(mpu, null_display, raw_display, no_aci, network, fast_display, alt_display, bench) if bench else Apple1System(mpu, console_display, raw_display, no_aci, network, fast_display, alt_display, bench)
+    # Display timing follows the emulated clock, the nominal one when unlimited.
+    # Deterministic runs have no keyboard: keys come from --type only
+    system = Apple1System(mpu, null_display if bench else None, raw_display, no_aci, network, fast_display, alt_display, bench, engine, roms,
+                          ConsoleFrontEnd(keyboard=not deterministic), net_session, mhz or 1.023, deterministic)
 
 
     # Initialize CPU
     system.reset()
 
-    if load_state: system.load_state(load_state)
+    if load_state:
+        try:
+            system.load_state(load_state)
+        except (OSError, ValueError) as e:
+            system.close()
+            sys.stderr.write(f'Can not load {load_state}: {e}\n')
+            return 1
+    if args.type: system.paste(args.type)
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler(args.profile_interval, args.profile_timer and args.profile_timer / 1000, 0 if deterministic else None)
+        system.cpu.profile(profiler)
+
+    tracer = None
+    if args.trace:
+        tracer = Tracer(args.trace_records)
+        system.cpu.trace(tracer)
+        if hasattr(signal, 'SIGUSR1'):
+            # dump on demand, between slices
+            signal.signal(signal.SIGUSR1, lambda signum, frame: system.post(lambda: tracer.dump(args.trace)))
+
+    for addr in args.breakpoint:
+        system.cpu.add_breakpoint(addr)
+    for start, end, access in args.watch:
+        system.cpu.add_watchpoint(start, end, access)
 
     if bench:
         start = time()
         count = 0
 
+    # Turbo and bench mode run at full speed, otherwise at the --mhz clock
+    pacer = None if turbo or bench or mhz is None else Pacer(mhz, system.cpu.processorCycles)
+
+    # Cycles per slice; between slices the display, keyboard events and pacing are handled
+    slice_cycles = 1000 if pacer is None else pacer.slice_cycles
+    frame = time() # console output is written once a frame
+
     try:
+        if args.script:
+            try:
+                run_script(Expect(system), args.script)
+            except ExpectFailed as e:
+                system.frontend.flush()
+                sys.stderr.write(f'\nScript failed at {system.cpu.processorCycles} cycles, {e}\n')
+                return 1
+            system.frontend.flush()
+            return
+
+        if deterministic:
+            stop = deterministic_run(system, args.cycles)
+            system.frontend.flush()
+            sys.stderr.write(f"{'Waiting for input' if stop == 'input' else 'Stopped'} after {system.cpu.processorCycles} cycles\n")
+            return
+
         while True:
-            # Execute one instruction (2-7 cycles)
-            system.step()
+            # Execute a slice of instructions
+            reason = system.run(slice_cycles)
+            # only the translated engine returns 'idle', the stepping ones go by polling()
+            idle = reason == 'idle' or system.waiting_for_input(reason)
+
+            if isinstance(reason, Break):
+                # Show where it stopped, then carry on after a key
+                system.frontend.flush()
+                sys.stdout.write(f'\r\nBreak: {reason.access} ${reason.address:04x} (${reason.value:02x}), press a key to continue\r\n'
+                                 + repr(system.cpu).replace('\n', '\r\n') + '\r\n')
+                sys.stdout.flush()
+                # wait_for_event() returns at once unless idle(), e.g. with the display busy
+                while True:
+                    system.input_event.clear()
+                    if system.kbd or system.terminated: break
+                    system.input_event.wait(1)
+                if system.kbd: system.kbd.popleft()
+                if pacer: pacer.resync(system.cpu.processorCycles)
+
 
-            if system.alt_display and system.dsp_buffer and time() >= system.dsp_clock:
-                system.display_callback(system, system.dsp_buffer.popleft(), system.raw_display)
-                system.dsp_clock = time() + 1 / 60.05
+            if idle or time() >= frame:
+                system.frontend.flush()
+                frame = time() + 1 / 60.05
 
-            # Non-turbo mode (will limit maximum speed, usually to a few KHz, which is normally enough for most Apple-1 software)
-            if not turbo: sleep(0.0000000001)
+            if pacer:
+                # Sleep off the time the slice is ahead; longer slices while idle
+                pacer.pace(system.cpu.processorCycles)
+                slice_cycles = pacer.idle_slice_cycles if idle else pacer.slice_cycles
+            elif idle:
+                # Polling the keyboard or display: sleep until something happens
+                system.wait_for_event(1 / 60.05)
 
             if bench:
                 if time() - start >= 1:
@@ -2068,15 +5054,26 @@ def apple1_emulator(args):
                     count = system.cpu.processorCycles
 
     except KeyboardInterrupt:
-        system.reset_terminal()
+        system.frontend.flush()
+        system.close()
         pass
     except Exception:
-        system.reset_terminal()
+        system.frontend.flush()
+        system.close()
         raise
+    finally:
+        if args.save_state:
+            system.save_state(args.save_state)
+        if profiler:
+            with open(args.profile, 'w') as f:
+                profiler.report(system.cpu, f)
+        if tracer:
+            tracer.dump(args.trace)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="An Apple-1 emulator based on the MOS 6502 microprocessor unit.")
     parser.add_argument('-t', '--turbo', action='store_true', help='run CPU at full speed')
+    parser.add_argument('--mhz', type=clock_speed, default=1.023, help="CPU clock in MHz, or 'unlimited' (default: 1.023)")
     parser.add_argument('-b', '--bench', action='store_true', help='test maximum CPU speed')
     parser.add_argument('-r', '--raw-display', action='store_true', help='do not simulate a 40-column display')
     parser.add_argument('-a', '--no-aci', action='store_true', help='disable Apple Cassette Interface')
@@ -2085,7 +5082,93 @@ if __name__ == "__main__":
     parser.add_argument('--alt-display', action='store_true', help='use alternate non-blocking 60 cps display')
     parser.add_argument('--65c02', action='store_true', help='use WDC 65C02 instead of NMOS 6502 (may cause compatibility issues)')
     parser.add_argument('-l', '--load-state', action='store', help='load save state from disk')
+    parser.add_argument('--save-state', metavar='FILE', help='write a save state to FILE on exit')
+    parser.add_argument('--rom', action='append', type=rom_image, default=[], metavar='FILE@ADDR', help='map a ROM image at a hex address (e.g. basic.bin@E000), can be repeated')
+    parser.add_argument('-e', '--engine', choices=MPU6502.ENGINES, default='translated', help='CPU execution engine (default: translated)')
+    parser.add_argument('--profile', metavar='FILE', help='sample where the emulated cycles go and write a report to FILE on exit')
+    parser.add_argument('--profile-interval', type=int, default=101, metavar='CYCLES', help='average cycles between profile samples (default: 101)')
+    parser.add_argument('--profile-timer', type=float, metavar='MS', help='take profile samples every MS milliseconds of host time instead')
+    parser.add_argument('--trace', metavar='FILE', help='record the last instructions run, written to FILE on exit, on a crash and on SIGUSR1')
+    parser.add_argument('--trace-records', type=int, default=1 << 20, metavar='N', help='instructions kept in the trace (default: 1048576, 18 bytes each)')
+    parser.add_argument('--break', dest='breakpoint', action='append', type=hex_address, default=[], metavar='ADDR', help='stop before the instruction at a hex address, can be repeated')
+    parser.add_argument('--watch', action='append', type=watch_range, default=[], metavar='START[-END][:r|w|rw]', help='stop after a read or write of a hex address range (default: rw), can be repeated')
+    parser.add_argument('--deterministic', action='store_true', help='run headless at full speed with all timing taken from the cycle count, until the CPU waits for input that --type has run out of')
+    parser.add_argument('--type', type=text_file, metavar='FILE', help='type the contents of a text file (e.g. a hex listing) at startup, as fast as it is read')
+    parser.add_argument('--cycles', type=int, metavar='N', help='stop a deterministic run once N cycles have run')
+    parser.add_argument('--script', type=script_file, metavar='FILE', help='run an expect script (send, sendline, expect, wait and timeout lines) deterministically, exit status 1 when an expect fails')
+    parser.add_argument('--net-record', metavar='DIR', help='save the network responses to DIR, a file per URL')
+    parser.add_argument('--net-replay', metavar='DIR', help='answer network requests from responses saved with --net-record')
+    subparsers = parser.add_subparsers(dest='command', metavar='command')
+    bench_parser = subparsers.add_parser('benchmark', help='run the benchmark workloads headless and report the results as JSON',
+                                         description='Runs fixed workloads headless and reports instructions/sec and cycles/sec as JSON.')
+    bench_parser.add_argument('-e', '--engine', choices=MPU6502.ENGINES, default='translated', help='CPU execution engine (default: translated)')
+    bench_parser.add_argument('--65c02', action='store_true', help='use WDC 65C02 instead of NMOS 6502')
+    bench_parser.add_argument('-n', '--repeat', type=int, default=5, help='timed runs per benchmark (default: 5)')
+    bench_parser.add_argument('-w', '--warmup', type=int, default=1, help='untimed runs before them (default: 1)')
+    bench_parser.add_argument('-o', '--output', help='write the JSON results to a file instead of stdout')
+    bench_parser.add_argument('--baseline', help='compare with the JSON results of an earlier run')
+    bench_parser.add_argument('--threshold', type=float, default=5, help='percent slower than the baseline that counts as a regression (default: 5)')
+    bench_parser.add_argument('--only', action='append', metavar='NAME', help=f"run only this benchmark, can be repeated ({', '.join(BENCHMARKS)}, functional-test)")
+    bench_parser.add_argument('--functional-test', type=rom_file, metavar='FILE', help='also run a 64K functional test image (e.g. 6502_functional_test.bin), started at $0400')
+    bench_parser.add_argument('--functional-success', type=hex_address, default=0x3469, metavar='ADDR', help='hex address of the trap the functional test ends in when it passes (default: 3469)')
+    serve_parser = subparsers.add_parser('serve', help='serve Apple-1 sessions to telnet clients',
+                                         description='Serves an Apple-1 to each TCP (telnet) connection, all from one process.')
+    serve_parser.add_argument('--host', default='127.0.0.1', help='address to listen on (default: 127.0.0.1)')
+    serve_parser.add_argument('-p', '--port', type=int, default=6502, help='port to listen on (default: 6502)')
+    serve_parser.add_argument('-e', '--engine', choices=MPU6502.ENGINES, default='translated', help='CPU execution engine (default: translated)')
+    serve_parser.add_argument('--65c02', action='store_true', help='use WDC 65C02 instead of NMOS 6502')
+    serve_parser.add_argument('--mhz', type=float, default=1.023, help='CPU clock of each machine in MHz (default: 1.023)')
+    serve_parser.add_argument('--slice', type=int, metavar='CYCLES', help='cycles each running machine gets per 1/60 s tick (default: a tick of its clock)')
+    serve_parser.add_argument('--max-sessions', type=int, default=64, help='connections served at once (default: 64)')
+    serve_parser.add_argument('-w', '--workers', type=int, default=0, metavar='N', help='run the machines on N worker processes, e.g. one per core (default: 0, in the server process)')
+    serve_parser.add_argument('-a', '--no-aci', action='store_true', help='disable Apple Cassette Interface')
+    serve_parser.add_argument('--rom', action='append', type=rom_image, default=[], metavar='FILE@ADDR', help='map a ROM image at a hex address, can be repeated')
+    decode_parser = subparsers.add_parser('decode-trace', help='print an instruction trace recorded with --trace',
+                                          description='Prints an instruction trace recorded with --trace, oldest first.')
+    decode_parser.add_argument('file', help='trace file')
+    decode_parser.add_argument('--last', type=int, metavar='N', help='only the last N instructions')
+    compact_parser = subparsers.add_parser('compact-state', help='merge a save state and deltas on it into one',
+                                           description='Writes the state a chain of save states ends in (a full one, then deltas, each on the one before) as one full save state.')
+    compact_parser.add_argument('files', nargs='+', help='save state files, oldest first')
+    compact_parser.add_argument('-o', '--output', required=True, help='file to write the full save state to')
     args = parser.parse_args()
-    if not requests_available and args.network: raise ModuleNotFoundError('Requests module not found. Install it with: pip install requests')
+    if args.command == 'decode-trace':
+        try:
+            decode_trace(args.file, last=args.last)
+        except BrokenPipeError:
+            sys.stdout = None # the reader went away (e.g. | head)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        sys.exit(0)
+    if args.command == 'compact-state':
+        try:
+            compact_states(args.files, args.output)
+        except (OSError, ValueError) as e:
+            parser.error(str(e))
+        sys.exit(0)
+    if args.command == 'serve':
+        if not args.mhz > 0 or (args.slice is not None and args.slice < 1) or args.max_sessions < 1 or args.workers < 0:
+            parser.error('serve needs a --mhz above 0, a --slice and --max-sessions of at least 1, and --workers of at least 0')
+        sys.exit(serve(args))
+    if args.command == 'benchmark':
+        if args.repeat < 1 or args.warmup < 0:
+            parser.error('benchmark needs --repeat of at least 1 and a --warmup of at least 0')
+        sys.exit(benchmark(args))
+    if args.profile_interval < 1: parser.error('--profile-interval must be at least 1')
+    if args.trace_records < 1: parser.error('--trace-records must be at least 1')
+    if args.profile and args.trace: parser.error('--profile and --trace can not be used together')
+    if (args.breakpoint or args.watch) and (args.profile or args.trace):
+        parser.error('--break and --watch can not be used with --profile or --trace')
+    if args.net_record and args.net_replay: parser.error('--net-record and --net-replay can not be used together')
+    if args.script:
+        if args.cycles is not None: parser.error('--cycles can not be used with --script, use timeout lines')
+        args.deterministic = True
+    if args.deterministic:
+        if args.bench: parser.error('--deterministic can not be used with --bench')
+        if args.profile_timer: parser.error('--deterministic can not be used with --profile-timer')
+        if args.network and not args.net_replay: parser.error('--deterministic needs --net-replay for --network')
+    elif args.cycles is not None:
+        parser.error('--cycles needs --deterministic')
+    if not requests_available and args.network and not args.net_replay: raise ModuleNotFoundError('Requests module not found. Install it with: pip install requests')
     if not args.no_aci and args.network: args.no_aci = True
-    apple1_emulator(args)
\ No newline at end of file
+    sys.exit(apple1_emulator(args))
\ No newline at end of file
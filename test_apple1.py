@@ -0,0 +1,250 @@
+import os, random, subprocess, sys, tempfile, time, unittest
+
+import apple1
+
+APPLE1 = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'apple1.py')
+
+
+class DeterministicSaveStateTest(unittest.TestCase):
+    def test_same_run_saves_same_bytes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            keys = os.path.join(directory, 'keys.txt')
+            with open(keys, 'w') as f:
+                f.write('300: A9 41 20 EF FF\n300.304\n')
+            states = []
+            for i in range(2):
+                state = os.path.join(directory, f'state{i}.bin')
+                subprocess.run([sys.executable, APPLE1, '--deterministic', '--type', keys, '--save-state', state],
+                               check=True, capture_output=True, timeout=120)
+                with open(state, 'rb') as f:
+                    states.append(f.read())
+            self.assertEqual(states[0], states[1])
+
+
+class SaveStateTest(unittest.TestCase):
+    def loop(self, value):
+        # LDA #value, JMP $0300
+        system = apple1.bench_system(apple1.MPU6502, 'translated', program=bytes([0xA9, value, 0x4C, 0x00, 0x03]))
+        system.run(1000)
+        return system
+
+    def test_failed_restore_leaves_machine_as_it_was(self):
+        state = self.loop(0x22).snapshot()
+        system = self.loop(0x11)
+        with self.assertRaises(ValueError):
+            system.restore(state[:-3])
+        self.assertEqual(system.memory[0x0301], 0x11)
+        system.run(1000)
+        self.assertEqual(system.cpu.a, 0x11)
+        system.restore(state)
+        system.run(1000)
+        self.assertEqual(system.cpu.a, 0x22)
+
+    def test_delta_refused_after_writes_it_does_not_cover(self):
+        system = self.loop(0x11)
+        full = system.snapshot()
+        system.run(1000)
+        delta = system.snapshot(delta=True)
+        target = self.loop(0x11)
+        target.restore(full)
+        target.restore(delta)
+        target.restore(full)
+        target.write(0x0700, 0x99)
+        with self.assertRaises(ValueError):
+            target.restore(delta)
+        self.assertEqual(target.memory[0x0700], 0x99)
+
+    def test_state_store_round_trip(self):
+        def registers(system):
+            cpu = system.cpu
+            return cpu.pc, cpu.a, cpu.x, cpu.y, cpu.sp, cpu.p, cpu.processorCycles
+        with tempfile.TemporaryDirectory() as directory:
+            system = self.loop(0x11)
+            store = apple1.StateStore(directory)
+            store.save(system, 'first')
+            size = os.path.getsize(os.path.join(directory, 'pages.pack'))
+            store.save(system, 'second') # the same pages: nothing more in the pack
+            self.assertEqual(os.path.getsize(os.path.join(directory, 'pages.pack')), size)
+            store.close()
+
+            store = apple1.StateStore(directory) # finds the pages in the pack again
+            try:
+                restored = self.loop(0x22)
+                store.load(restored, 'first')
+                self.assertEqual(restored.memory, system.memory)
+                self.assertEqual(registers(restored), registers(system))
+                # a stored state is a checkpoint: a delta goes on it
+                restored.write(0x0700, 0x99)
+                restored.run(1000)
+                delta = restored.snapshot(delta=True)
+                self.assertIn(b'BASE', apple1.unpack_state(delta)[1])
+                other = self.loop(0x33)
+                store.load(other, 'second')
+                other.restore(delta)
+                self.assertEqual(other.memory, restored.memory)
+                self.assertEqual(registers(other), registers(restored))
+            finally:
+                store.close()
+
+
+class RunUntilTest(unittest.TestCase):
+    def test_run_until_pc_stops_at_watchpoints(self):
+        # LDA #1, STA $0400, JMP $0300
+        system = apple1.bench_system(apple1.MPU6502, 'translated', program=bytes([0xA9, 0x01, 0x8D, 0x00, 0x04, 0x4C, 0x00, 0x03]))
+        system.cpu.add_watchpoint(0x0400, access='w')
+        self.assertEqual(system.run_until(pc=0x0305, max_cycles=1000), apple1.Break(0x0400, 'write', 0x01))
+        system.cpu.clear_breakpoints()
+        self.assertEqual(system.run_until(pc=0x0305, max_cycles=1000), 'pc')
+        self.assertEqual(system.cpu.pc, 0x0305)
+
+    def test_run_until_pc_hides_wai(self):
+        system = apple1.bench_system(apple1.MPU65C02, 'translated', program=bytes([0xCB])) # WAI
+        self.assertIsNone(system.run_until(pc=0x0400, max_cycles=1000))
+        self.assertTrue(system.cpu.waiting)
+
+
+class OptionsTest(unittest.TestCase):
+    def test_break_and_watch_rejected_with_trace_and_profile(self):
+        for debug in (['--break', 'FF00'], ['--watch', '0300:w']):
+            for option in ('--trace', '--profile'):
+                result = subprocess.run([sys.executable, APPLE1, *debug, option, os.devnull],
+                                        capture_output=True, text=True, timeout=60)
+                self.assertEqual(result.returncode, 2)
+                self.assertIn('--break and --watch can not be used with --profile or --trace', result.stderr)
+
+
+class SessionPoolMoveTest(unittest.TestCase):
+    def test_snapshot_while_moving(self):
+        pool = apple1.SessionPool(dict(mpu=apple1.MPU6502), 17050, 2)
+        try:
+            events = {}
+            numbers = [pool.open(lambda kind, data, i=i: events.setdefault(i, []).append(kind)) for i in range(6)]
+            end = time.monotonic() + 10
+            while sum('idle' in events.get(i, ()) for i in range(6)) < 6:
+                self.assertLess(time.monotonic(), end)
+                pool.poll(0.1)
+            first = [i for i in range(6) if pool.sessions[numbers[i]].worker is pool.workers[0]]
+            for i in first[:2]:
+                pool.send(numbers[i], b'300: 4C 00 03\r300R\r') # JMP $0300
+            moving = first[2]
+            events[moving].clear()
+            pool.send(numbers[moving], b'300\r') # wakes it on the busier worker: it moves
+            pool.snapshot(numbers[moving])
+            while 'idle' not in events[moving] or 'state' not in events[moving]:
+                self.assertLess(time.monotonic(), end)
+                pool.poll(0.1)
+            self.assertIs(pool.sessions[numbers[moving]].worker, pool.workers[1])
+        finally:
+            pool.close()
+
+
+class EngineTest(unittest.TestCase):
+    def state(self, cpu):
+        return cpu.pc, cpu.a, cpu.x, cpu.y, cpu.sp, cpu.p, cpu.processorCycles, bytes(cpu.memory)
+
+    def machine(self, mpu, engine, image, registers):
+        cpu = mpu(bytearray(image), pc=0x0200, engine=engine)
+        for name, value in registers.items():
+            setattr(cpu, name, value)
+        return cpu
+
+    def test_every_opcode_matches_reference(self):
+        for mpu in (apple1.MPU6502, apple1.MPU65C02):
+            rng = random.Random(1)
+            for opcode in range(256):
+                for _ in range(2):
+                    image = bytearray(rng.randbytes(0x10000))
+                    image[0x0200] = opcode
+                    registers = dict(a=rng.getrandbits(8), x=rng.getrandbits(8), y=rng.getrandbits(8),
+                                     sp=rng.getrandbits(8), p=rng.getrandbits(8) | 0x30)
+                    for engine in ('generated', 'translated'):
+                        # a translated step runs a whole block: the reference engine steps to the same place
+                        cpu = self.machine(mpu, engine, image, registers).step()
+                        reference = self.machine(mpu, 'reference', image, registers)
+                        for _ in range(100):
+                            reference.step()
+                            if reference.processorCycles >= cpu.processorCycles and reference.pc == cpu.pc:
+                                break
+                        with self.subTest(mpu=mpu.__name__, engine=engine, opcode=f'{opcode:02x}'):
+                            self.assertEqual(self.state(cpu), self.state(reference))
+
+    def test_self_modifying_code(self):
+        program = bytes([
+            0xA9, 0x22,       # 0200 LDA #$22
+            0x8D, 0x06, 0x02, # 0202 STA $0206, the operand of the next instruction
+            0xA9, 0x11,       # 0205 LDA #$11
+            0x9D, 0x00, 0x04, # 0207 STA $0400,X
+            0xE8,             # 020a INX
+            0xE0, 0x02,       # 020b CPX #2
+            0xF0, 0x08,       # 020d BEQ $0217
+            0xA9, 0x33,       # 020f LDA #$33
+            0x8D, 0x01, 0x02, # 0211 STA $0201, in the first block
+            0x4C, 0x00, 0x02, # 0214 JMP $0200
+            0x4C, 0x17, 0x02, # 0217 JMP $0217
+        ])
+        image = bytearray(0x10000)
+        image[0x0200:0x0200 + len(program)] = program
+        for mpu in (apple1.MPU6502, apple1.MPU65C02):
+            reference = self.machine(mpu, 'reference', image, {})
+            reference.run(1000)
+            self.assertEqual(reference.memory[0x0400:0x0402], bytearray([0x22, 0x33]))
+            for engine in ('generated', 'translated'):
+                cpu = self.machine(mpu, engine, image, {})
+                cpu.run(1000)
+                with self.subTest(mpu=mpu.__name__, engine=engine):
+                    self.assertEqual(self.state(cpu), self.state(reference))
+
+
+class ProfilerTest(unittest.TestCase):
+    def test_reset_mid_profile(self):
+        system = apple1.bench_system(apple1.MPU6502, 'translated')
+        profiler = apple1.Profiler(seed=1)
+        system.cpu.profile(profiler)
+        system.run(20000)
+        before = system.cpu.processorCycles
+        system.reset()
+        system.run(20000)
+        after = system.cpu.processorCycles
+        system.cpu.profile(None)
+        self.assertEqual(profiler.cycles, before + after)
+        # one sample per 101 cycles on average, on both sides of the reset
+        self.assertGreater(profiler.samples, (before + after) // 101 * 3 // 4)
+
+
+class SessionPoolTest(unittest.TestCase):
+    def test_bad_state_closes_only_its_session(self):
+        pool = apple1.SessionPool(dict(mpu=apple1.MPU6502), 17050, 1)
+        try:
+            events = []
+            good = pool.open(lambda kind, data: events.append(('good', kind)))
+            pool.open(lambda kind, data: events.append(('bad', kind)), b'A1SS\x09' + bytes(100))
+            end = time.monotonic() + 10
+            while ('good', 'idle') not in events or ('bad', 'closed') not in events:
+                self.assertLess(time.monotonic(), end)
+                pool.poll(0.1)
+            self.assertNotIn(('good', 'closed'), events)
+            self.assertEqual(len(pool.workers), 1)
+            pool.kill(good)
+        finally:
+            pool.close()
+
+    def test_busy_worker_still_reads_messages(self):
+        # slices much longer than a tick
+        pool = apple1.SessionPool(dict(mpu=apple1.MPU6502), 600000, 1)
+        try:
+            events = []
+            busy = pool.open(lambda kind, data: None)
+            pool.send(busy, b'300: 4C 00 03\r300R\r') # JMP $0300
+            for _ in range(5):
+                pool.poll(0.1)
+            pool.open(lambda kind, data: events.append(kind))
+            end = time.monotonic() + 5
+            while 'idle' not in events:
+                self.assertLess(time.monotonic(), end)
+                pool.poll(0.1)
+        finally:
+            pool.close()
+
+
+if __name__ == '__main__':
+    unittest.main()